@@ -1,8 +1,12 @@
 # config/settings.py
 
 import os
+import sys
 from dotenv import load_dotenv # Optional: for loading .env file in local development
 
+# Start-up notes are collected and written to stderr in one call at the end of this module
+_startup_notes = []
+
 # Optional: Load .env file if it exists (useful for local development)
 # Create a .env file in your project root with lines like:
 # ADMIN_TELEGRAM_ID_ENV="1234567890"
@@ -10,9 +14,9 @@ from dotenv import load_dotenv # Optional: for loading .env file in local develo
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env') # Assumes .env is in project root
 if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
-    print(f"[CONFIG_SETTINGS] Loaded environment variables from: {dotenv_path}")
+    _startup_notes.append(f"[CONFIG_SETTINGS] Loaded environment variables from: {dotenv_path}")
 else:
-    print(f"[CONFIG_SETTINGS] .env file not found at {dotenv_path}, will rely on system environment variables.")
+    _startup_notes.append(f"[CONFIG_SETTINGS] .env file not found at {dotenv_path}, will rely on system environment variables.")
 
 
 # --- Admin Telegram ID ---
@@ -23,11 +27,11 @@ ADMIN_TELEGRAM_ID = None
 
 if ADMIN_TELEGRAM_ID_STR and ADMIN_TELEGRAM_ID_STR.isdigit():
     ADMIN_TELEGRAM_ID = int(ADMIN_TELEGRAM_ID_STR)
-    print(f"[CONFIG_SETTINGS] ADMIN_TELEGRAM_ID loaded from environment variable: {ADMIN_TELEGRAM_ID}")
+    _startup_notes.append(f"[CONFIG_SETTINGS] ADMIN_TELEGRAM_ID loaded from environment variable: {ADMIN_TELEGRAM_ID}")
 else:
     # Fallback or warning if not set or not a valid integer
     # For production, you might want to raise an error if it's not set.
-    print(f"[CONFIG_SETTINGS] WARNING: ADMIN_TELEGRAM_ID_ENV not set in environment or is not a valid integer ('{ADMIN_TELEGRAM_ID_STR}'). User message forwarding to admin will be disabled unless set directly in code (not recommended for production).")
+    _startup_notes.append(f"[CONFIG_SETTINGS] WARNING: ADMIN_TELEGRAM_ID_ENV not set in environment or is not a valid integer ('{ADMIN_TELEGRAM_ID_STR}'). User message forwarding to admin will be disabled unless set directly in code (not recommended for production).")
     # You could set a default test ID here for local dev if you don't use .env, but it's better to use .env or actual env vars.
     # ADMIN_TELEGRAM_ID = 123456789 # Example: FOR LOCAL TESTING ONLY if no env var and no .env
 
@@ -38,7 +42,7 @@ USER_MESSAGE_FORWARD_KEYWORDS = [
     'feedback', 'problem', 'agent', 'contact', 'assistance', 'trouble',
     'confused', 'dont understand', "don't understand", 'how to', 'howto'
 ]
-print(f"[CONFIG_SETTINGS] Loaded {len(USER_MESSAGE_FORWARD_KEYWORDS)} keywords for admin forwarding.")
+_startup_notes.append(f"[CONFIG_SETTINGS] Loaded {len(USER_MESSAGE_FORWARD_KEYWORDS)} keywords for admin forwarding.")
 
 # --- Logging Configuration ---
 LOGS_DIR_NAME = "logs" # Define the directory name
@@ -50,14 +54,21 @@ LOGS_DIR_PATH = os.path.join(PROJECT_ROOT_DIR, LOGS_DIR_NAME)
 
 USER_MESSAGES_LOGFILE = os.path.join(LOGS_DIR_PATH, "user_messages.log")
 USER_INPUTS_CSVFILE = os.path.join(LOGS_DIR_PATH, "user_inputs.csv")
+USER_INPUTS_JSONLFILE = os.path.join(LOGS_DIR_PATH, "user_inputs.jsonl")
+# Structured user input sink: "csv" (default, the existing user_inputs.csv) or "jsonl" to opt in to JSON lines
+USER_INPUTS_FORMAT = os.environ.get("USER_INPUTS_FORMAT", "csv").lower()
 
-print(f"[CONFIG_SETTINGS] USER_MESSAGES_LOGFILE path: {USER_MESSAGES_LOGFILE}")
-print(f"[CONFIG_SETTINGS] USER_INPUTS_CSVFILE path: {USER_INPUTS_CSVFILE}")
+_startup_notes.append(f"[CONFIG_SETTINGS] USER_MESSAGES_LOGFILE path: {USER_MESSAGES_LOGFILE}")
+_startup_notes.append(f"[CONFIG_SETTINGS] USER_INPUTS_CSVFILE path: {USER_INPUTS_CSVFILE}")
+_startup_notes.append(f"[CONFIG_SETTINGS] USER_INPUTS_JSONLFILE path: {USER_INPUTS_JSONLFILE} (USER_INPUTS_FORMAT={USER_INPUTS_FORMAT})")
 
 # --- Other Potential Bot Settings (Examples) ---
 # BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN") # You likely have this in start_bot.py, but could centralize
 # DEFAULT_LANGUAGE = "en"
 # MAX_MESSAGE_LENGTH_TO_LOG = 2000
 
-# You can add print statements for all loaded settings for easier debugging during startup
-# print(f"[CONFIG_SETTINGS] Final ADMIN_TELEGRAM_ID: {ADMIN_TELEGRAM_ID}")
\ No newline at end of file
+# You can add start-up notes for all loaded settings for easier debugging during startup
+# _startup_notes.append(f"[CONFIG_SETTINGS] Final ADMIN_TELEGRAM_ID: {ADMIN_TELEGRAM_ID}")
+
+sys.stderr.write("\n".join(_startup_notes) + "\n")
+del _startup_notes
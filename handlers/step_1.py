@@ -2,16 +2,16 @@
 
 import asyncio
 import logging
-import hashlib
 import random
-from typing import List
+from typing import List, Optional
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.constants import ChatAction, ParseMode
+from telegram.constants import ChatAction
 from telegram.ext import ContextTypes
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, TimedOut, NetworkError
 
-from utils.helpers import TimedMessage, send_delayed_message, generate_user_secure_id, send_system_error_reply
+from utils.helpers import TimedMessage, coalesce_timed_messages, send_delayed_message, send_delayed_sequence, generate_user_secure_id, send_system_error_reply
+from utils.state_definitions import get_flow_state
 
 logger = logging.getLogger(__name__)
 
@@ -19,31 +19,123 @@ logger = logging.getLogger(__name__)
 UNIFIED_FLOW_ACTIVE = "unified_flow_active_s1_v3" # Versioning state names
 UNIFIED_FLOW_PAYMENT_LINK_SENT = "unified_flow_payment_link_sent_s1_v3"
 # No processing/complete states needed here as it's a URL button
+# The current state lives in FlowState.s1_state (utils/state_definitions.py)
+
+# States in which a repeated /start resets the flow (and in which free text counts as an interrupt)
+_RESETTABLE_FLOW_STATES = frozenset({UNIFIED_FLOW_ACTIVE, UNIFIED_FLOW_PAYMENT_LINK_SENT})
 
 # --- HELPER FOR SCRIPT IDs ---
 def _generate_internal_flow_id(prefix: str, length: int = 8) -> str:
-    random_hex = hashlib.sha256(str(random.random()).encode()).hexdigest().upper()
-    return f"{prefix.upper()}-{random_hex[:length]}"
+    # Display-only IDs: `length` random hex digits straight from the PRNG, no hashing needed.
+    return f"{prefix.upper()}-{random.getrandbits(length * 4):0{length}X}"
+
+# --- Static reply markup (shared across users; PTB markups are immutable once built) ---
+GUMROAD_ENTRY_URL = "https://syncprotocol.gumroad.com/l/ENTRY_SYNC_49"
+_KB_SECURE_PORTAL = InlineKeyboardMarkup([[
+    InlineKeyboardButton("🔗 ENTER SECURE PORTAL – $49", url=GUMROAD_ENTRY_URL)
+]])
 
 # --- Constants for dynamic content generation ---
 INTEGRITY_MIN = 24.5
 INTEGRITY_MAX = 49.5
 SEED_MAX_VAL = 65535
 
+# --- Scripted Step 1 sequence (built once at import; `{placeholders}` are filled per user) ---
+_STEP_1_INTRO_SEQUENCE = coalesce_timed_messages((
+    # --- 【STEP A】SYSTEM IDENTIFICATION & THREAT ALERT ---
+    TimedMessage(
+        "<code>[LOG: Z1_SYS_ALERT_001]</code>\n🟥🟥🟧⬜⬜ <b>[SYSTEM ALERT]</b> Node anomaly detected.",
+        delay_before=1.2, chat_action=ChatAction.UPLOAD_DOCUMENT,
+    ),
+    TimedMessage(
+        "<code>[LOG: Z1_SYS_SCAN_002]</code>\n🧬📉 <code>[SCAN COMPLETE]</code> Threat level: <b>HIGH</b>.",
+        delay_before=3.2, chat_action=ChatAction.RECORD_VOICE,
+    ),
+    TimedMessage(
+        "<code>[LOG: Z1_SYS_ID_003]</code>\n🧠🆔 [NODE ID] <b>{secure_id}</b>",
+        delay_before=3.2,
+    ),
+    # --- 【STEP B】DIAGNOSTIC REPORT & ACTION MANDATE ---
+    TimedMessage(
+        "<code>[LOG: Z1_SYS_DIAG_004]</code>\n"
+        "📊🧠 [DIAGNOSTIC REPORT] <i>Critical failure</i> in node integrity.\n"
+        "<b>Status:</b> 🟥🟥🟥🟥🟧 (Integrity: <code>{integrity_val}%</code>)",
+        delay_before=1.5, chat_action=ChatAction.UPLOAD_VIDEO,
+    ),
+    TimedMessage(
+        "<code>[LOG: Z1_SYS_ACTION_005]</code>\n"
+        "⚠️🔧 <b>[ACTION REQUIRED]</b> Immediate system intervention mandated.\n"
+        "<i>System override: SLOT [<code>{slot_id}</code>] secured for immediate recalibration.</i>",
+        delay_before=4.5, chat_action=ChatAction.RECORD_VIDEO_NOTE,
+    ),
+    TimedMessage(
+        "<code>[SYS NODE AI::echo]</code> Node stabilization task [#{node_echo_id}] acknowledged.",
+        delay_before=1.0, group=1,
+    ),
+    TimedMessage(
+        "<code>[LOG: Z1_SYS_SLOT_006]</code>\n🔒🆔 [SLOT ID] <code>{slot_id}</code>",
+        delay_before=2.0, group=1, # Sent together with the echo line above as one log bubble
+    ),
+    # --- 【STEP C】LOCK SEQUENCE + ACCESS INITIATION ---
+    TimedMessage(
+        "<code>[LOG: Z1_SYS_KEY_007]</code>\n"
+        "🔐 Root Protocol: SYNC_SEED::<code>{sync_seed}</code> (checksum:<code>{checksum}</code>) → <b>KEY DERIVED</b>\n"
+        "🔑⏳ [ACCESS KEY] <b>{access_key}</b>\n"
+        "KEY validation sequence initiated: <b>[Phase 1/3 Complete]</b>",
+        delay_before=1.8, chat_action=ChatAction.UPLOAD_PHOTO,
+    ),
+    TimedMessage(
+        "<b>⚠️ Activation Slot Reserved</b>\n"
+        "Only <code>1</code> access slot remains for your Node ID.\n\n"
+        "<code>[LOG: Z1_SYS_TIMER_008]</code>\n"
+        "⏰⚠️ [TIME REMAINING] <code>08:43 LEFT</code>\n\n"
+        "<b>Note:</b> Action cannot be reversed once initiated.\n\n"
+        "<i>Clicking below will open a secure payment portal for your activation.</i>",
+        delay_before=2.5, reply_markup=_KB_SECURE_PORTAL,
+    ),
+))
+_STEP_1_GATEWAY_SEQUENCE = (
+    TimedMessage(
+        "<code>[LOG: Z1_SYS_GATEWAY_009]</code>\n"
+        "✅ <b>Link confirmed</b>. Finalizing your session on the secure gateway...\n"
+        "Please complete the process on the opened page.",
+        delay_before=1.0,
+    ),
+)
+
+# --- Other fixed replies and keys (built once at import, not per update) ---
+_S1_RESET_TEXT = "🔄 System reset. Re-initiating Z1-Gray protocol..."
+# Telegram HTML has no <br>: line breaks are plain "\n"
+_S1_ECHO_MON_TEXT = (
+    "<code>[LOG: Z1_ECHO_MON]</code> 🧠 External signal received.\n"
+    "<b>Manual input logged. Processing will resume once current protocol completes.</b>"
+)
+_S1_INPUT_DISRUPTION_DELAY_S = 3.0
+# Per-run display values the script writes to user_data; cleared on a mid-flow reset
+_S1_SCRIPT_USER_DATA_KEYS = (
+    "user_secure_id_z1_s1_v3", "slot_id_z1_s1_v3",
+    "access_key_z1_s1_v3", "integrity_value_s1_v3", "sync_seed_s1_v3",
+    "node_echo_id_s1_v3", "checksum_val_s1_v3",
+)
+
 async def start_main_unified_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.message or not update.effective_chat:
+    message = update.message
+    chat = update.effective_chat
+    user = update.effective_user
+    ud = context.user_data
+
+    if not message or not chat:
         logger.warning("start_main_unified_flow: Missing message or effective_chat.")
         return
 
-    user = update.effective_user
     if not user:
         logger.warning("start_main_unified_flow: Effective user is None.")
-        await send_system_error_reply(update, context, "UserNotFoundS1V3", custom_error_text="User identification failed.")
+        await send_system_error_reply(update, context, error_code="UserNotFoundS1V3", custom_error_text="User identification failed.")
         return
 
     user_id = user.id
-    chat_id = update.effective_chat.id
-    context.user_data["user_id"] = user_id
+    chat_id = chat.id
+    fs = get_flow_state(ud)
 
     # AI_MODIFIED_BLOCK_START: Added logging for context.args (start payload)
     args = context.args  # This will be a list of strings after /start, e.g., ['payload_from_lp']
@@ -52,241 +144,162 @@ async def start_main_unified_flow(update: Update, context: ContextTypes.DEFAULT_
     if args:
         start_payload = args[0] # Get the first argument as the payload
         entry_source_payload = start_payload # Store the actual payload
-        logger.info(f"[BOT_START_HANDLER] User {user_id} (Chat: {chat_id}) started with payload: '{start_payload}' from context.args[0]. Full args: {args}")
-        context.user_data['entry_source'] = start_payload # Store in user_data
+        logger.info("[BOT_START_HANDLER] User %s (Chat: %s) started with payload: '%s' from context.args[0]. Full args: %s", user_id, chat_id, start_payload, args)
     else:
-        logger.info(f"[BOT_START_HANDLER] User {user_id} (Chat: {chat_id}) started without a payload (direct /start or unknown source).")
-        context.user_data['entry_source'] = entry_source_payload # Store default in user_data
+        logger.info("[BOT_START_HANDLER] User %s (Chat: %s) started without a payload (direct /start or unknown source).", user_id, chat_id)
+    fs.user_id = user_id
+    fs.entry_source = entry_source_payload # Store in user_data (via FlowState)
     # AI_MODIFIED_BLOCK_END
 
-    current_flow_state_key = "current_z1_unified_flow_s1_v3_state" # Unique state key
-    current_flow_state = context.user_data.get(current_flow_state_key)
-
-    active_states_for_reset = [UNIFIED_FLOW_ACTIVE, UNIFIED_FLOW_PAYMENT_LINK_SENT]
-    if update.message.text == "/start" and current_flow_state in active_states_for_reset:
-        logger.info(f"[Unified Z1 Flow S1 V3] User {user_id} sent /start mid-flow ({current_flow_state}). Resetting.")
-        await update.message.reply_html("🔄 System reset. Re-initiating Z1-Gray protocol...")
-        keys_to_clear = [
-            current_flow_state_key, "user_secure_id_z1_s1_v3", "slot_id_z1_s1_v3", 
-            "access_key_z1_s1_v3", "integrity_value_s1_v3", "sync_seed_s1_v3", 
-            "node_echo_id_s1_v3", "checksum_val_s1_v3" # Ensured all relevant keys are listed
-        ]
-        for key in keys_to_clear:
-            context.user_data.pop(key, None)
-
-    # Original log now includes the entry_source from the payload or default
-    logger.info(f"[Unified Z1 Flow S1 V3] User {user_id} (Chat: {chat_id}, Source: {entry_source_payload}) starting script with final button optimizations.")
-    context.user_data[current_flow_state_key] = UNIFIED_FLOW_ACTIVE
+    # Cancel a script still running from an earlier /start (e.g. /start spam) so sequences never overlap.
+    previous_task = fs.intro_task
+    fs.intro_task = None
+    if previous_task is not None and not previous_task.done():
+        logger.info("[Unified Z1 Flow S1 V3] User %s sent /start while the script is still running. Restarting it.", user_id)
+        previous_task.cancel()
+
+    # All state mutation happens before the script is scheduled so a concurrent /start sees it.
+    current_flow_state = fs.s1_state
+    # This runs under CommandHandler("start"), so the text is always a /start command; a bare /start
+    # (no deep-link payload) is simply `not args`, with no string comparison needed.
+    reset_requested = current_flow_state in _RESETTABLE_FLOW_STATES and not args
+    if reset_requested:
+        for key in _S1_SCRIPT_USER_DATA_KEYS:
+            ud.pop(key, None)
+    fs.s1_state = UNIFIED_FLOW_ACTIVE
+
+    # The ~20s scripted sequence runs as a background task so this handler returns immediately
+    # and does not hold an update-processing slot for the whole script.
+    fs.intro_task = context.application.create_task(
+        _run_unified_flow_script(
+            update, context, chat_id, user_id, entry_source_payload,
+            reset_from_state=current_flow_state if reset_requested else None,
+        ),
+        update=update,
+    )
+
+async def _run_unified_flow_script(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    user_id: int,
+    entry_source_payload: str,
+    reset_from_state: Optional[str] = None,
+) -> None:
+    """Sends the scripted Step A/B/C sequence. Scheduled by start_main_unified_flow; may be cancelled by a later /start."""
+    ud = context.user_data
+    fs = get_flow_state(ud)
+    bot = context.bot
 
     try:
-        # --- 【STEP A】SYSTEM IDENTIFICATION & THREAT ALERT ---
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT)
-        await asyncio.sleep(0.3)
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        text_a1 = "<code>[LOG: Z1_SYS_ALERT_001]</code>\n🟥🟥🟧⬜⬜ <b>[SYSTEM ALERT]</b> Node anomaly detected."
-        msg_delay_a1 = 1.2 - 0.3
-        
-        # Apply disruption delay before sending message
-        delay_override = context.user_data.pop("input_disruption_delay_s", 0)
-        if delay_override > 0:
-            logger.info(f"[Unified Z1 Flow S1 V3] Applying input disruption delay of {delay_override}s for user {user_id} before A1.")
-            await asyncio.sleep(delay_override)
-
-        if update.message:
-            await send_delayed_message(context.bot, chat_id, text_a1, delay_before=msg_delay_a1, show_typing=False) # NO context
-        else:
-            await send_delayed_message(context.bot, chat_id, text_a1, delay_before=msg_delay_a1, show_typing=False) # NO context
-
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.RECORD_VOICE)
-        await asyncio.sleep(1.2)
-        text_a2 = "<code>[LOG: Z1_SYS_SCAN_002]</code>\n🧬📉 <code>[SCAN COMPLETE]</code> Threat level: <b>HIGH</b>."
-        msg_delay_a2 = 3.2 - 1.2
-        
-        delay_override = context.user_data.pop("input_disruption_delay_s", 0)
-        if delay_override > 0:
-            logger.info(f"[Unified Z1 Flow S1 V3] Applying input disruption delay of {delay_override}s for user {user_id} before A2.")
-            await asyncio.sleep(delay_override)
-        await send_delayed_message(context.bot, chat_id, text_a2, delay_before=msg_delay_a2, show_typing=True) # NO context
-
-        raw_secure_id = generate_user_secure_id(user_id)
-        user_secure_id_display = f"USR-{raw_secure_id[:8]}"
-        context.user_data["user_secure_id_z1_s1_v3"] = user_secure_id_display
-        text_a3 = f"<code>[LOG: Z1_SYS_ID_003]</code>\n🧠🆔 [NODE ID] <b>{user_secure_id_display}</b>"
-        
-        delay_override = context.user_data.pop("input_disruption_delay_s", 0)
-        if delay_override > 0:
-            logger.info(f"[Unified Z1 Flow S1 V3] Applying input disruption delay of {delay_override}s for user {user_id} before A3.")
-            await asyncio.sleep(delay_override)
-        await send_delayed_message(context.bot, chat_id, text_a3, delay_before=3.2, show_typing=True) # NO context
-        logger.info(f"[Unified Z1 Flow S1 V3] User {user_id}: Step A messages sent.")
-
-        # --- 【STEP B】DIAGNOSTIC REPORT & ACTION MANDATE ---
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_VIDEO)
-        await asyncio.sleep(1.3)
+        if reset_from_state:
+            logger.info("[Unified Z1 Flow S1 V3] User %s sent /start mid-flow (%s). Resetting.", user_id, reset_from_state)
+            await update.message.reply_html(_S1_RESET_TEXT)
+
+        # Original log now includes the entry_source from the payload or default
+        logger.info("[Unified Z1 Flow S1 V3] User %s (Chat: %s, Source: %s) starting script with final button optimizations.", user_id, chat_id, entry_source_payload)
+
+        # secure_id is deliberately not cleared on reset: it is stable per user, so re-entry reuses it.
+        # It is also what Step 2 reads for its node-ID logs.
+        user_secure_id_display = fs.secure_id
+        if user_secure_id_display is None:
+            user_secure_id_display = fs.secure_id = f"USR-{generate_user_secure_id(user_id)[:8]}"
+
+        # Per-user values for the `{placeholder}`s in _STEP_1_INTRO_SEQUENCE
         integrity_val = round(random.uniform(INTEGRITY_MIN, INTEGRITY_MAX), 1)
-        context.user_data["integrity_value_s1_v3"] = integrity_val
-        text_b1 = (f"<code>[LOG: Z1_SYS_DIAG_004]</code>\n"
-                   f"📊🧠 [DIAGNOSTIC REPORT] <i>Critical failure</i> in node integrity.\n"
-                   f"<b>Status:</b> 🟥🟥🟥🟥🟧 (Integrity: <code>{integrity_val}%</code>)")
-        msg_delay_b1 = 1.5 - 1.3
-        
-        delay_override = context.user_data.pop("input_disruption_delay_s", 0)
-        if delay_override > 0:
-            logger.info(f"[Unified Z1 Flow S1 V3] Applying input disruption delay of {delay_override}s for user {user_id} before B1.")
-            await asyncio.sleep(delay_override)
-        await send_delayed_message(context.bot, chat_id, text_b1, delay_before=msg_delay_b1, show_typing=True) # NO context
-
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.RECORD_VIDEO_NOTE)
-        await asyncio.sleep(1.2)
         slot_id = _generate_internal_flow_id("SLT")
-        context.user_data["slot_id_z1_s1_v3"] = slot_id
-        text_b2 = (f"<code>[LOG: Z1_SYS_ACTION_005]</code>\n"
-                   f"⚠️🔧 <b>[ACTION REQUIRED]</b> Immediate system intervention mandated.\n"
-                   f"<i>System override: SLOT [<code>{slot_id}</code>] secured for immediate recalibration.</i>")
-        msg_delay_b2 = 4.5 - 1.2
-        
-        delay_override = context.user_data.pop("input_disruption_delay_s", 0)
-        if delay_override > 0:
-            logger.info(f"[Unified Z1 Flow S1 V3] Applying input disruption delay of {delay_override}s for user {user_id} before B2.")
-            await asyncio.sleep(delay_override)
-        await send_delayed_message(context.bot, chat_id, text_b2, delay_before=msg_delay_b2, show_typing=True) # NO context
-        
         node_echo_id = format(random.randint(0, SEED_MAX_VAL), '04X')
-        context.user_data["node_echo_id_s1_v3"] = node_echo_id
-        text_b2_echo = (f"<code>[SYS NODE AI::echo]</code> Node stabilization task [#{node_echo_id}] acknowledged.")
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        
-        delay_override = context.user_data.pop("input_disruption_delay_s", 0)
-        if delay_override > 0:
-           logger.info(f"[Unified Z1 Flow S1 V3] Applying input disruption delay of {delay_override}s for user {user_id} before B2_echo.")
-           await asyncio.sleep(delay_override)
-        await send_delayed_message(context.bot, chat_id, text_b2_echo, delay_before=1.0, show_typing=False) # NO context
-
-        text_b3 = f"<code>[LOG: Z1_SYS_SLOT_006]</code>\n🔒🆔 [SLOT ID] <code>{slot_id}</code>"
-        
-        delay_override = context.user_data.pop("input_disruption_delay_s", 0)
-        if delay_override > 0:
-            logger.info(f"[Unified Z1 Flow S1 V3] Applying input disruption delay of {delay_override}s for user {user_id} before B3.")
-            await asyncio.sleep(delay_override)
-        await send_delayed_message(context.bot, chat_id, text_b3, delay_before=2.0, show_typing=True) # NO context
-        logger.info(f"[Unified Z1 Flow S1 V3] User {user_id}: Step B messages (with AI echo) sent.")
-
-        # --- 【STEP C】LOCK SEQUENCE + ACCESS INITIATION ---
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_PHOTO)
-        await asyncio.sleep(1.2)
         access_key = _generate_internal_flow_id("AKY")
-        context.user_data["access_key_z1_s1_v3"] = access_key
         sync_seed_val = format(random.randint(0, SEED_MAX_VAL), '04X')
-        context.user_data["sync_seed_s1_v3"] = sync_seed_val
         checksum_val = format(random.randint(0, SEED_MAX_VAL), '04X')
-        context.user_data["checksum_val_s1_v3"] = checksum_val
-        text_c1 = (
-            f"<code>[LOG: Z1_SYS_KEY_007]</code>\n"
-            f"🔐 Root Protocol: SYNC_SEED::<code>{sync_seed_val}</code> (checksum:<code>{checksum_val}</code>) → <b>KEY DERIVED</b>\n"
-            f"🔑⏳ [ACCESS KEY] <b>{access_key}</b>\n"
-            f"KEY validation sequence initiated: <b>[Phase 1/3 Complete]</b>"
-        )
-        msg_delay_c1 = 1.8 - 1.2
-        
-        delay_override = context.user_data.pop("input_disruption_delay_s", 0)
-        if delay_override > 0:
-            logger.info(f"[Unified Z1 Flow S1 V3] Applying input disruption delay of {delay_override}s for user {user_id} before C1.")
-            await asyncio.sleep(delay_override)
-        await send_delayed_message(context.bot, chat_id, text_c1, delay_before=msg_delay_c1, show_typing=True) # NO context
-
-        text_c2_with_button = (
-            f"<b>⚠️ Activation Slot Reserved</b>\n"
-            f"Only <code>1</code> access slot remains for your Node ID.\n\n"
-            f"<code>[LOG: Z1_SYS_TIMER_008]</code>\n"
-            f"⏰⚠️ [TIME REMAINING] <code>08:43 LEFT</code>\n\n"
-            f"<b>Note:</b> Action cannot be reversed once initiated.\n\n"
-            f"<i>Clicking below will open a secure payment portal for your activation.</i>"
+        # One bulk write instead of seven: a single call (and a single dirty-mark under persistence).
+        ud.update(
+            user_secure_id_z1_s1_v3=user_secure_id_display,
+            integrity_value_s1_v3=integrity_val,
+            slot_id_z1_s1_v3=slot_id,
+            node_echo_id_s1_v3=node_echo_id,
+            access_key_z1_s1_v3=access_key,
+            sync_seed_s1_v3=sync_seed_val,
+            checksum_val_s1_v3=checksum_val,
         )
-        gumroad_url = "https://syncprotocol.gumroad.com/l/ENTRY_SYNC_49"
-        keyboard_c2 = InlineKeyboardMarkup([[
-            InlineKeyboardButton("🔗 ENTER SECURE PORTAL – $49", url=gumroad_url)
-        ]])
-
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        await asyncio.sleep(2.5)
-        
-        delay_override = context.user_data.pop("input_disruption_delay_s", 0)
-        if delay_override > 0:
-           logger.info(f"[Unified Z1 Flow S1 V3] Applying input disruption delay of {delay_override}s for user {user_id} before C2_button.")
-           await asyncio.sleep(delay_override)
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=text_c2_with_button,
-            reply_markup=keyboard_c2,
-            parse_mode=ParseMode.HTML
+        script_fields = {
+            "secure_id": user_secure_id_display,
+            "integrity_val": integrity_val,
+            "slot_id": slot_id,
+            "node_echo_id": node_echo_id,
+            "access_key": access_key,
+            "sync_seed": sync_seed_val,
+            "checksum": checksum_val,
+        }
+
+        def _pop_input_disruption_delay() -> float:
+            # Set by handle_unexpected_input when the user types mid-script; consumed once.
+            delay_override = fs.input_disruption_delay_s
+            fs.input_disruption_delay_s = 0.0
+            if delay_override > 0:
+                logger.info("[Unified Z1 Flow S1 V3] Applying input disruption delay of %ss for user %s.", delay_override, user_id)
+            return delay_override
+
+        sent = await send_delayed_sequence(
+            bot, chat_id, _STEP_1_INTRO_SEQUENCE, fields=script_fields, extra_delay=_pop_input_disruption_delay
         )
-        context.user_data[current_flow_state_key] = UNIFIED_FLOW_PAYMENT_LINK_SENT
-        logger.info(f"[Unified Z1 Flow S1 V3] User {user_id}: Step C payment URL button sent.")
-
-        await asyncio.sleep(2.8) 
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        await asyncio.sleep(1.0)
-        text_gateway_confirmation_msg = (
-            "<code>[LOG: Z1_SYS_GATEWAY_009]</code>\n"
-            "✅ <b>Link confirmed</b>. Finalizing your session on the secure gateway...\n"
-            "Please complete the process on the opened page."
+        if sent[-1] is None:
+            # The payment portal button is the point of the script; don't advance state without it.
+            logger.error("[Unified Z1 Flow S1 V3] User %s: Step C payment URL button could not be sent.", user_id)
+            await send_system_error_reply(update, context, user_id, error_code="S1V3_PORTAL_SEND", custom_error_text="A system communication error occurred.")
+            return
+        fs.s1_state = UNIFIED_FLOW_PAYMENT_LINK_SENT
+        logger.info("[Unified Z1 Flow S1 V3] User %s: Step A/B messages and Step C payment URL button sent.", user_id)
+
+        # Silent pause after the portal button; typing shows only during the gateway item's own 1.0s delay
+        await asyncio.sleep(2.8)
+        await send_delayed_sequence(
+            bot, chat_id, _STEP_1_GATEWAY_SEQUENCE, extra_delay=_pop_input_disruption_delay
         )
-        
-        delay_override = context.user_data.pop("input_disruption_delay_s", 0)
-        if delay_override > 0:
-           logger.info(f"[Unified Z1 Flow S1 V3] Applying input disruption delay of {delay_override}s for user {user_id} before GatewayConfirm.")
-           await asyncio.sleep(delay_override)
-        await context.bot.send_message(chat_id=chat_id, text=text_gateway_confirmation_msg, parse_mode=ParseMode.HTML)
-        logger.info(f"[Unified Z1 Flow S1 V3] User {user_id}: Sent 'Link confirmed' gateway message.")
-
+        logger.info("[Unified Z1 Flow S1 V3] User %s: Sent 'Link confirmed' gateway message.", user_id)
+
+    except RetryAfter as e:
+        # Expected under load: no traceback, just the retry hint.
+        logger.warning("[Unified Z1 Flow S1 V3] RetryAfter for user %s: retry in %ss", user_id, e.retry_after)
+        await send_system_error_reply(update, context, user_id, error_code="S1V3_TGERR_RetryAfter", custom_error_text="A system communication error occurred.")
+    except (TimedOut, NetworkError) as e:
+        logger.warning("[Unified Z1 Flow S1 V3] Network error for user %s: %r", user_id, e)
+        await send_system_error_reply(update, context, user_id, error_code=f"S1V3_TGERR_{e.__class__.__name__}", custom_error_text="A system communication error occurred.")
     except TelegramError as e:
-        logger.error(f"[Unified Z1 Flow S1 V3] TelegramError for user {user_id}: {e}", exc_info=True)
+        logger.exception("[Unified Z1 Flow S1 V3] TelegramError for user %s: %r", user_id, e)
         await send_system_error_reply(update, context, user_id, error_code=f"S1V3_TGERR_{e.__class__.__name__}", custom_error_text="A system communication error occurred.")
     except Exception as e:
-        logger.error(f"[Unified Z1 Flow S1 V3] General error for user {user_id}: {e}", exc_info=True)
+        logger.exception("[Unified Z1 Flow S1 V3] General error for user %s: %r", user_id, e)
         await send_system_error_reply(update, context, user_id, error_code="S1V3_GENERR", custom_error_text="An unexpected error occurred.")
 
 # --- Function to handle unexpected user text input during the flow ---
 async def handle_unexpected_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.message or not update.effective_chat or not update.effective_user:
+    message = update.message
+    chat = update.effective_chat
+    user = update.effective_user
+    if not message or not chat or not user:
         logger.warning("handle_unexpected_input: Received update without crucial attributes.")
         return
 
-    chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    text_received = update.message.text
-    logger.info(f"[Unexpected Input] User {user_id} in chat {chat_id} sent text during flow: '{text_received[:50]}'")
-
-    current_flow_state_key = "current_z1_unified_flow_s1_v3_state"
-    current_state = context.user_data.get(current_flow_state_key)
+    fs = get_flow_state(context.user_data)
+    bot = context.bot
+    chat_id = chat.id
+    user_id = user.id
+    text_received = message.text
+    logger.info("[Unexpected Input] User %s in chat %s sent text during flow: '%.50s'", user_id, chat_id, text_received)
 
-    valid_interrupt_states = [
-        UNIFIED_FLOW_ACTIVE,
-        UNIFIED_FLOW_PAYMENT_LINK_SENT 
-    ]
+    current_state = fs.s1_state
 
-    if current_state not in valid_interrupt_states:
-        logger.info(f"[Unexpected Input] User {user_id} sent text but not in an active Z1-Gray flow state ({current_state}). Ignoring.")
+    if current_state not in _RESETTABLE_FLOW_STATES:
+        logger.info("[Unexpected Input] User %s sent text but not in an active Z1-Gray flow state (%s). Ignoring.", user_id, current_state)
         return
 
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-    await asyncio.sleep(0.8) 
-
-    reply_text_html = (
-        "<code>[LOG: Z1_ECHO_MON]</code> 🧠 External signal received.<br>"
-        "<b>Manual input logged. Processing will resume once current protocol completes.</b>"
-    )
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=reply_text_html,
-        parse_mode=ParseMode.HTML,
-        disable_web_page_preview=True
-    )
-    logger.info(f"[Unexpected Input] Sent Z1_ECHO_MON reply to user {user_id}.")
+    # Typing indicator overlaps the 0.8s pause instead of adding its own round trip before it
+    if await send_delayed_message(bot, chat_id, _S1_ECHO_MON_TEXT, delay_before=0.8) is not None:
+        logger.info("[Unexpected Input] Sent Z1_ECHO_MON reply to user %s.", user_id)
 
-    disruption_delay_seconds = 3.0
-    context.user_data["input_disruption_delay_s"] = disruption_delay_seconds
-    logger.info(f"[Unexpected Input] Set input_disruption_delay_s to {disruption_delay_seconds}s for user {user_id}.")
+    fs.input_disruption_delay_s = _S1_INPUT_DISRUPTION_DELAY_S
+    logger.info("[Unexpected Input] Set input_disruption_delay_s to %ss for user %s.", _S1_INPUT_DISRUPTION_DELAY_S, user_id)
 
 
 logger.info("handlers.step_1 (unified flow v3 with final enhancements and input handling) module loaded.")
\ No newline at end of file
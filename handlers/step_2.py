@@ -1,88 +1,120 @@
 import asyncio
 import logging
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from telegram.constants import ChatAction, ParseMode
 from telegram.ext import ContextTypes
+from telegram.error import RetryAfter, TimedOut, NetworkError
 
-from utils.helpers import TimedMessage, send_delayed_sequence, send_system_error_reply
+from utils.helpers import TimedMessage, drop_unneeded_html_parse_mode, send_delayed_message, send_delayed_sequence, send_system_error_reply
+from utils.state_definitions import FLOW_STATE_KEY, get_flow_state
 
 STEP_2_SCAN_COMPLETE_AWAITING_S3 = "step_2_scan_complete_awaiting_s3"
 CALLBACK_S3_VIEW_DIAGNOSIS = "s3_view_diagnosis"
 
 logger = logging.getLogger(__name__)
 
+# Built once at import; the markup is immutable and safe to share across users.
+_KB_TO_S3 = InlineKeyboardMarkup([[
+    InlineKeyboardButton("▶️ 获取权威诊断及唯一修复协议 (步骤 ③)", callback_data=CALLBACK_S3_VIEW_DIAGNOSIS)
+]])
+
+# --- 使用您最初定义的“剧本原文”（英文术语 + 指定中文解释） ---
+# Built once at import. `{secure_id}` in system_log is filled in by send_delayed_sequence(fields=...).
+# These texts carry no markup; drop_unneeded_html_parse_mode sends them with parse_mode=None.
+_STEP_2_SCAN_SEQUENCE = drop_unneeded_html_parse_mode((
+    TimedMessage(
+        text="📡 Initiating Signal Resonance Scan...\n→ 追踪节点信号启动中…", # 严格按照您最初给的剧本
+        delay_before=2.5, typing=True,
+        system_log="[RESONANCE_LOCKED: USER_PATTERN_MATCH → GAMMA-7-SIG :: {secure_id}]" # system_log 保留之前的优化
+    ),
+    TimedMessage(
+        text="⚠️ SIGNAL_VARIANCE = Δ0.83\n→ 当前节点出现信号漂移偏差 Δ0.83", # 严格按照您最初给的剧本
+        delay_before=3.0, typing=True,
+        system_log="[SIGNAL_PROFILE_DEVIATION_LOGGED: Δ0.83 → USER_ADAPTIVE_REALIGNMENT_QUEUED :: {secure_id}]"
+    ),
+    TimedMessage(
+        text="🧠 NODE STABILITY STATUS = DEGRADED\n→ 节点稳定性等级：已降级", # 严格按照您最初给的剧本
+        delay_before=2.0, typing=True,
+        system_log="[STABILITY_TRACE_TRIGGERED: CORE_PATTERN_DISSONANCE_DETECTED → ESCALATED TO TRACKER-L2 :: {secure_id}]"
+    ),
+    TimedMessage(
+        text="🔒 SYSTEM_LOCK ACTIVE\n→ 外部输入已锁定，系统自适应排查中…", # 严格按照您最初给的剧本
+        delay_before=2.5, typing=True,
+        system_log="[SECURE_SCAN_MODE_ENABLED → NODE_ISOLATION_FOR_USER: {secure_id}]"
+    ),
+    TimedMessage(
+        text="📉 TRACE SIGNAL INTEGRITY = 67.3% (BELOW SAFE THRESHOLD)\n→ 信号完整性不足，当前状态已低于安全临界", # 严格按照您最初给的剧本
+        delay_before=3.0, typing=True,
+        system_log="[THRESHOLD_BREACH → ATTRACTOR_LINK: DEGRADED — NODE_ID: {secure_id}]"
+    ),
+    TimedMessage(
+        text="🧬 NODE ANOMALY LEVEL = UNSUPERVISED\n→ 当前异常未被用户主动触发\n→ 建议进行深度诊断以避免节点剔除。", # 严格按照您最初给的剧本
+        delay_before=3.5, typing=True,
+        system_log="[ANOMALY_TYPE: OMEGA-4 — USER_NODE_FLAGGED_FOR_PRIORITY_OBSERVATION :: {secure_id}]"
+    ),
+))
+# --- END OF MESSAGES ---
+
 async def execute_step_2_scan_sequence(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.callback_query or not update.callback_query.message or not update.effective_user:
+    query = update.callback_query
+    msg = query.message if query else None
+    user = update.effective_user
+    ud = context.user_data
+    bot = context.bot
+
+    if not query or not msg or not user:
         logger.error("[Step ②] execute_step_2_scan_sequence called with invalid Update or User context.")
-        user_id_for_error = update.effective_user.id if update.effective_user else "Unknown"
-        if user_id_for_error == "Unknown" and context.user_data and "user_id" in context.user_data:
-            user_id_for_error = context.user_data["user_id"]
-        await send_system_error_reply(update.callback_query if update.callback_query else None, context, user_id_for_error, "Internal error processing Step ② sequence (E401).")
+        user_id_for_error = user.id if user else "Unknown"
+        if user_id_for_error == "Unknown" and ud and FLOW_STATE_KEY in ud and ud[FLOW_STATE_KEY].user_id is not None:
+            user_id_for_error = ud[FLOW_STATE_KEY].user_id
+        await send_system_error_reply(query, context, user_id_for_error, error_code="S2_E401", custom_error_text="Internal error processing Step ② sequence (E401).")
         return
 
-    chat_id = update.callback_query.message.chat_id
-    user_id = update.effective_user.id
-    context.user_data["user_id"] = user_id
-    user_secure_id = context.user_data.get("secure_id", "NODE_ID_MISSING")
+    chat_id = msg.chat_id
+    user_id = user.id
+    fs = get_flow_state(ud)
+    fs.user_id = user_id
+    user_secure_id = fs.secure_id or "NODE_ID_MISSING"
 
-    if context.user_data.get("current_flow_step") == STEP_2_SCAN_COMPLETE_AWAITING_S3:
-        logger.warning(f"[Step ②] User {user_id} re-triggered completed scan (current_flow_step is {STEP_2_SCAN_COMPLETE_AWAITING_S3}). Ignoring repeat execution.")
+    if fs.current_flow_step == STEP_2_SCAN_COMPLETE_AWAITING_S3:
+        logger.warning("[Step ②] User %s re-triggered completed scan (current_flow_step is %s). Ignoring repeat execution.", user_id, STEP_2_SCAN_COMPLETE_AWAITING_S3)
         try:
-            await update.callback_query.answer("Scan already completed. Proceed to Step ③ if available.")
+            await query.answer("Scan already completed. Proceed to Step ③ if available.")
         except Exception as e_answer:
-            logger.warning(f"Failed to answer callback query for re-trigger: {e_answer}")
+            logger.warning("Failed to answer callback query for re-trigger: %s", e_answer)
         return
 
-    logger.info(f"[Step ②] Executing deep scan message sequence for user_id: {user_id} ({user_secure_id})")
-
-    # --- 使用您最初定义的“剧本原文”（英文术语 + 指定中文解释） ---
-    step_2_scan_messages = [
-        TimedMessage(
-            text="📡 Initiating Signal Resonance Scan...\n→ 追踪节点信号启动中…", # 严格按照您最初给的剧本
-            delay_before=2.5, typing=True,
-            system_log=f"[RESONANCE_LOCKED: USER_PATTERN_MATCH → GAMMA-7-SIG :: {user_secure_id}]" # system_log 保留之前的优化
-        ),
-        TimedMessage(
-            text="⚠️ SIGNAL_VARIANCE = Δ0.83\n→ 当前节点出现信号漂移偏差 Δ0.83", # 严格按照您最初给的剧本
-            delay_before=3.0, typing=True,
-            system_log=f"[SIGNAL_PROFILE_DEVIATION_LOGGED: Δ0.83 → USER_ADAPTIVE_REALIGNMENT_QUEUED :: {user_secure_id}]"
-        ),
-        TimedMessage(
-            text="🧠 NODE STABILITY STATUS = DEGRADED\n→ 节点稳定性等级：已降级", # 严格按照您最初给的剧本
-            delay_before=2.0, typing=True,
-            system_log=f"[STABILITY_TRACE_TRIGGERED: CORE_PATTERN_DISSONANCE_DETECTED → ESCALATED TO TRACKER-L2 :: {user_secure_id}]"
-        ),
-        TimedMessage(
-            text="🔒 SYSTEM_LOCK ACTIVE\n→ 外部输入已锁定，系统自适应排查中…", # 严格按照您最初给的剧本
-            delay_before=2.5, typing=True,
-            system_log=f"[SECURE_SCAN_MODE_ENABLED → NODE_ISOLATION_FOR_USER: {user_secure_id}]"
-        ),
-        TimedMessage(
-            text="📉 TRACE SIGNAL INTEGRITY = 67.3% (BELOW SAFE THRESHOLD)\n→ 信号完整性不足，当前状态已低于安全临界", # 严格按照您最初给的剧本
-            delay_before=3.0, typing=True,
-            system_log=f"[THRESHOLD_BREACH → ATTRACTOR_LINK: DEGRADED — NODE_ID: {user_secure_id}]"
-        ),
-        TimedMessage(
-            text="🧬 NODE ANOMALY LEVEL = UNSUPERVISED\n→ 当前异常未被用户主动触发\n→ 建议进行深度诊断以避免节点剔除。", # 严格按照您最初给的剧本
-            delay_before=3.5, typing=True,
-            system_log=f"[ANOMALY_TYPE: OMEGA-4 — USER_NODE_FLAGGED_FOR_PRIORITY_OBSERVATION :: {user_secure_id}]"
-        ),
-    ]
-    # --- END OF MESSAGES ---
-
-    try:
-        await send_delayed_sequence(context.bot, chat_id, step_2_scan_messages, initial_delay=0.8)
-        logger.info(f"[Step ②] Core message sequence completed for user {user_id} ({user_secure_id})")
+    if fs.s2_scan_running:
+        # Updates are dispatched concurrently, so a double-tap can arrive while the first scan is still sending.
+        logger.warning("[Step ②] User %s re-triggered a scan that is still running. Ignoring repeat execution.", user_id)
+        try:
+            await query.answer("Scan already in progress.")
+        except Exception as e_answer:
+            logger.warning("Failed to answer callback query for re-trigger: %s", e_answer)
+        return
+    fs.s2_scan_running = True # Before the first await, so a second tap sees it
 
-        context.user_data["current_flow_step"] = STEP_2_SCAN_COMPLETE_AWAITING_S3
-        logger.info(f"[Step ②] User {user_id} ({user_secure_id}) state marked as {STEP_2_SCAN_COMPLETE_AWAITING_S3}")
+    logger.info("[Step ②] Executing deep scan message sequence for user_id: %s (%s)", user_id, user_secure_id)
 
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        await asyncio.sleep(2.0)
+    try:
+        # Acknowledge the click (stops the client's loading spinner) while the scan sequence starts;
+        # the two are independent, so they share one round trip instead of two.
+        ack_result, sent = await asyncio.gather(
+            query.answer(),
+            send_delayed_sequence(bot, chat_id, _STEP_2_SCAN_SEQUENCE, initial_delay=0.8, fields={"secure_id": user_secure_id}),
+            return_exceptions=True,
+        )
+        if isinstance(ack_result, BaseException):
+            logger.warning("Failed to answer callback query for user %s: %s", user_id, ack_result)
+        if isinstance(sent, BaseException):
+            raise sent
+        if sent[-1] is None:
+            # The sequence aborts its tail on a failed send; don't mark an incomplete scan as done.
+            await send_system_error_reply(query, context, user_id, error_code="S2_E402", custom_error_text="An error occurred during the node scan process (E402).")
+            return
+        logger.info("[Step ②] Core message sequence completed for user %s (%s)", user_id, user_secure_id)
 
-        keyboard_to_s3 = InlineKeyboardMarkup([[
-            InlineKeyboardButton("▶️ 获取权威诊断及唯一修复协议 (步骤 ③)", callback_data=CALLBACK_S3_VIEW_DIAGNOSIS)
-        ]])
+        fs.current_flow_step = STEP_2_SCAN_COMPLETE_AWAITING_S3
+        logger.info("[Step ②] User %s (%s) state marked as %s", user_id, user_secure_id, STEP_2_SCAN_COMPLETE_AWAITING_S3)
 
         # 这个引导至步骤三的中文消息保持不变，因为它在剧本中是作为Step 2结束后的引导，且包含ACCESS_KEY术语
         transition_message_text = (
@@ -93,14 +125,19 @@ async def execute_step_2_scan_sequence(update: Update, context: ContextTypes.DEF
             "<b>警告：</b>延迟操作可能导致当前访问密钥 (ACCESS_KEY) 失效及节点资格审查。"
         )
 
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=transition_message_text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=keyboard_to_s3
-        )
-        logger.info(f"[Step ②] Guided user {user_id} ({user_secure_id}) to Step ③ with callback {CALLBACK_S3_VIEW_DIAGNOSIS}")
+        # send_delayed_message overlaps the typing action with the 2s pause instead of awaiting them in turn.
+        transition_msg = await send_delayed_message(bot, chat_id, transition_message_text, delay_before=2.0, reply_markup=_KB_TO_S3)
+        if transition_msg is None:
+            await send_system_error_reply(query, context, user_id, error_code="S2_E402", custom_error_text="An error occurred during the node scan process (E402).")
+            return
+        logger.info("[Step ②] Guided user %s (%s) to Step ③ with callback %s", user_id, user_secure_id, CALLBACK_S3_VIEW_DIAGNOSIS)
 
+    except (RetryAfter, TimedOut, NetworkError) as e:
+        # Transient Telegram failures: log without a traceback.
+        logger.warning("[Step ②] Transient Telegram error for user %s (%s): %r", user_id, user_secure_id, e)
+        await send_system_error_reply(query, context, user_id, error_code="S2_E402", custom_error_text="An error occurred during the node scan process (E402).")
     except Exception as e:
-        logger.error(f"[Step ②] Error during execute_step_2_scan_sequence for user {user_id} ({user_secure_id}): {e}", exc_info=True)
-        await send_system_error_reply(update.callback_query, context, user_id, "An error occurred during the node scan process (E402).")
\ No newline at end of file
+        logger.exception("[Step ②] Error during execute_step_2_scan_sequence for user %s (%s): %r", user_id, user_secure_id, e)
+        await send_system_error_reply(query, context, user_id, error_code="S2_E402", custom_error_text="An error occurred during the node scan process (E402).")
+    finally:
+        fs.s2_scan_running = False
\ No newline at end of file
@@ -1,11 +1,26 @@
 # handlers/step_3.py
+import asyncio
 import logging
 from telegram import Update
 from telegram.ext import ContextTypes
+from telegram.error import RetryAfter, TimedOut, NetworkError
 # from telegram.constants import ParseMode # 暂时不需要，因为只发送简单文本
 
+from utils.helpers import send_throttled_message
+
 logger = logging.getLogger(__name__)
 
+async def _send_s3_error_reply(msg, bot, user_id: int) -> None:
+    """s3_entry_handler 出错时告知用户 (E302)；回复本身失败只记录日志。"""
+    try:
+        # 尝试回复原始消息，如果编辑或新消息失败
+        if msg:
+             await msg.reply_text("处理您的请求时发生错误 (E302)。请稍后重试。")
+        elif bot and user_id: # 作为最后的手段直接发送消息
+             await bot.send_message(chat_id=user_id, text="处理您的请求时发生错误 (E302)。请稍后重试。")
+    except Exception as e_reply:
+        logger.error("[Step ③] CRITICAL: Failed to send error reply in s3_entry_handler (minimal): %s", e_reply)
+
 async def s3_entry_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     极简占位处理函数，用于响应从 Step 2 过来的回调。
@@ -20,40 +35,43 @@ async def s3_entry_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             try:
                 await query.answer("发生错误，请重试。 (E301)")
             except Exception as e_ans:
-                logger.error(f"Failed to answer query in s3_entry_handler (minimal): {e_ans}")
+                logger.error("Failed to answer query in s3_entry_handler (minimal): %s", e_ans)
         return
 
     user_id = user.id
-    logger.info(f"[Step ③] User {user_id} entered Step ③ (minimal placeholder). Callback data: {query.data}")
+    msg = query.message
+    chat_id = msg.chat_id if msg else user_id
+    bot = context.bot
+    logger.info("[Step ③] User %s entered Step ③ (minimal placeholder). Callback data: %s", user_id, query.data)
 
     try:
-        # 给用户一个即时反馈
-        await query.answer("正在处理您的请求...")
-
         # 编辑上一条消息，简单告知已进入Step 3 (可选，如果想保持界面清爽可以不编辑)
         # await query.edit_message_text(
         #     text="➡️ 已进入步骤 ③。",
         #     reply_markup=None # 清除旧按钮
         # )
 
-        # 发送一条简单的占位消息
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="步骤 ③ 已激活。功能正在开发中，敬请期待！"
+        # 即时反馈 + 占位消息（经由全局/单聊限流器，与其他步骤共用同一配额）：
+        # 两者互不依赖，并发发送，用户只等一次往返
+        ack_result, send_result = await asyncio.gather(
+            query.answer("正在处理您的请求..."),
+            send_throttled_message(bot, chat_id, "步骤 ③ 已激活。功能正在开发中，敬请期待！"),
+            return_exceptions=True,
         )
+        if isinstance(ack_result, BaseException):
+            logger.warning("[Step ③] Failed to answer callback query for user %s: %r", user_id, ack_result)
+        if isinstance(send_result, BaseException):
+            raise send_result
 
         # （可选）可以简单更新一个状态，表明用户至少点击了进入Step 3的按钮
         # context.user_data["current_flow_step"] = "STEP_3_PLACEHOLDER_ACTIVE"
 
-        logger.info(f"[Step ③] User {user_id}: Minimal placeholder message sent.")
+        logger.info("[Step ③] User %s: Minimal placeholder message sent.", user_id)
 
+    except (RetryAfter, TimedOut, NetworkError) as e:
+        # 网络/限流类的暂时性错误：不记录完整堆栈
+        logger.warning("[Step ③] Transient Telegram error in s3_entry_handler for user %s: %r", user_id, e)
+        await _send_s3_error_reply(msg, bot, user_id)
     except Exception as e:
-        logger.error(f"[Step ③] Error in s3_entry_handler (minimal) for user {user_id}: {e}", exc_info=True)
-        try:
-            # 尝试回复原始消息，如果编辑或新消息失败
-            if query and query.message:
-                 await query.message.reply_text("处理您的请求时发生错误 (E302)。请稍后重试。")
-            elif context.bot and user_id: # 作为最后的手段直接发送消息
-                 await context.bot.send_message(chat_id=user_id, text="处理您的请求时发生错误 (E302)。请稍后重试。")
-        except Exception as e_reply:
-            logger.error(f"[Step ③] CRITICAL: Failed to send error reply in s3_entry_handler (minimal): {e_reply}")
\ No newline at end of file
+        logger.exception("[Step ③] Error in s3_entry_handler (minimal) for user %s: %r", user_id, e)
+        await _send_s3_error_reply(msg, bot, user_id)
\ No newline at end of file
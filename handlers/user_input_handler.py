@@ -1,10 +1,18 @@
 # handlers/user_input_handler.py
 
 from telegram import Update
-from telegram.ext import ContextTypes # Ensure this is the correct import for your PTB version
-from datetime import datetime
+from telegram.constants import ParseMode
+from telegram.ext import Application, ContextTypes # Ensure this is the correct import for your PTB version
+import asyncio
+import html
+import logging
 import os
-import csv
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Dict, List, Tuple, Union
+
+logger = logging.getLogger(__name__)
 
 # Attempt to import settings from the config module
 try:
@@ -13,144 +21,271 @@ try:
         USER_MESSAGE_FORWARD_KEYWORDS,
         USER_MESSAGES_LOGFILE,
         USER_INPUTS_CSVFILE,
-        # You might want to add a default logger from your bot_loader or settings
-        # For now, we'll use context.logger if available, or print
+        USER_INPUTS_JSONLFILE,
+        USER_INPUTS_FORMAT,
     )
 except ImportError:
     # Fallback or default values if settings.py is not found or variables are missing
     # This is crucial for standalone testing or if settings are structured differently
-    print("WARNING: Could not import settings from config.settings. Using fallback values for user_input_handler.")
+    logger.warning("[USER_INPUT_HANDLER] Could not import settings from config.settings. Using fallback values.")
     ADMIN_TELEGRAM_ID = None # Must be set for forwarding to work
     USER_MESSAGE_FORWARD_KEYWORDS = ['help', 'stuck', 'issue', 'problem', 'support', 'question', 'assist'] # Default English keywords
     LOGS_DIR_DEFAULT = "logs"
     USER_MESSAGES_LOGFILE = os.path.join(LOGS_DIR_DEFAULT, "user_messages.log")
     USER_INPUTS_CSVFILE = os.path.join(LOGS_DIR_DEFAULT, "user_inputs.csv")
+    USER_INPUTS_JSONLFILE = os.path.join(LOGS_DIR_DEFAULT, "user_inputs.jsonl")
+    USER_INPUTS_FORMAT = "csv"
+
+# orjson is optional: same JSON lines either way, the C encoder is just faster
+try:
+    import orjson
+
+    def _json_line(obj: Dict[str, Any]) -> bytes:
+        return orjson.dumps(obj) + b"\n"
+except ImportError:
+    import json
+
+    def _json_line(obj: Dict[str, Any]) -> bytes:
+        return (json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+# Structured sink: user_inputs.csv by default; JSON lines only with USER_INPUTS_FORMAT=jsonl
+_USER_INPUTS_AS_CSV = USER_INPUTS_FORMAT != "jsonl"
+_USER_INPUTS_FILE = USER_INPUTS_CSVFILE if _USER_INPUTS_AS_CSV else USER_INPUTS_JSONLFILE
+
+# The log paths never change, so their directories are created once, at import
+for _log_dir in {os.path.dirname(USER_MESSAGES_LOGFILE) or "logs", os.path.dirname(_USER_INPUTS_FILE) or "logs"}:
+    os.makedirs(_log_dir, exist_ok=True)
+
+# One case-insensitive alternation compiled at import: a single pass over the text, no lowercased copy
+_KW_RE = re.compile(
+    "|".join(re.escape(keyword) for keyword in USER_MESSAGE_FORWARD_KEYWORDS), re.IGNORECASE
+) if USER_MESSAGE_FORWARD_KEYWORDS else None
+# Decided once: with no admin or no keywords the handler skips the forward branch entirely
+_FORWARD_ENABLED = bool(ADMIN_TELEGRAM_ID) and _KW_RE is not None
+if not _FORWARD_ENABLED:
+    logger.warning("[ADMIN_FORWARD] ADMIN_TELEGRAM_ID or forward keywords not set. User messages will not be forwarded.")
+# HTML rather than MarkdownV2: only the message text needs escaping (html.escape, one C-level pass);
+# Telegram usernames are [A-Za-z0-9_] and the ID is numeric
+_FORWARD_TEMPLATE = (
+    "📥 <b>User Message Alert</b> (Keyword Triggered)\n\n"
+    "👤 <b>User:</b> @{username} (ID: <code>{user_id}</code>)\n"
+    "💬 <b>Message:</b>\n<code>{message}</code>"
+)
+
+# --- Batched file logging ---
+# The handler only enqueues (log line, structured row) pairs; a single background flusher drains whatever
+# has accumulated and writes it with one write() per file, so file I/O stays off the update path.
+# The writes themselves run on one dedicated worker thread (ordered, and a slow disk never blocks the loop).
+_USER_LOG_BATCH_MAX = 256
+# Group commit: buffered bytes reach the OS once a second, or sooner once this much is pending
+_USER_LOG_FLUSH_INTERVAL_S = 1.0
+_USER_LOG_FLUSH_BYTES = 32 * 1024
+# Fixed schema, so rows are built by hand; "\r\n" matches what csv.writer produced for existing files
+_CSV_HEADER = b"timestamp_iso,user_id,username,message_text\r\n"
+# Bounded so a stalled disk cannot grow memory without limit; overflow entries are dropped, not awaited
+_USER_LOG_QUEUE_MAX = 10_000
+_USER_LOG_DROP_WARN_INTERVAL_S = 60.0
+_user_log_queue: "asyncio.Queue[Tuple[str, bytes]]" = asyncio.Queue(maxsize=_USER_LOG_QUEUE_MAX)
+_user_log_dropped = 0 # Entries dropped since the last warning
+_user_log_drop_warned_at = 0.0 # time.monotonic() of the last warning
+_user_log_flusher_task: Union["asyncio.Task[None]", None] = None
+_user_log_ticker_task: Union["asyncio.Task[None]", None] = None
+_user_log_pending_bytes = 0 # Written but not yet flushed; only updated on the writer thread
+# Created per start_user_log_flusher (so a second post_init in the same process gets a fresh one)
+_user_log_executor: Union[ThreadPoolExecutor, None] = None
+# Opened once by start_user_log_flusher and kept for the process lifetime (no per-batch open/close)
+_user_log_fh: Union[BinaryIO, None] = None
+_user_rows_fh: Union[BinaryIO, None] = None # Rows arrive already encoded (JSON lines or CSV)
+
+def _note_user_log_drop() -> None:
+    """Counts an entry dropped on a full queue; warns at most once per _USER_LOG_DROP_WARN_INTERVAL_S."""
+    global _user_log_dropped, _user_log_drop_warned_at
+    _user_log_dropped += 1
+    now = time.monotonic()
+    if now - _user_log_drop_warned_at >= _USER_LOG_DROP_WARN_INTERVAL_S:
+        logger.warning("[USER_INPUT_LOG] User log queue full (%d entries); dropped %d entries since last warning.",
+                       _USER_LOG_QUEUE_MAX, _user_log_dropped)
+        _user_log_dropped = 0
+        _user_log_drop_warned_at = now
+
+def _utc_timestamps() -> Tuple[str, str]:
+    """Returns (log timestamp, ISO timestamp) for now in UTC from one clock read, without a datetime object."""
+    secs, frac_ns = divmod(time.time_ns(), 1_000_000_000)
+    t = time.gmtime(secs)
+    iso = (f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}T"
+           f"{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}.{frac_ns // 1000:06d}")
+    return iso[:19].replace("T", " ") + " UTC", iso
+
+def _csv_escape(value: str) -> str:
+    """Quotes a CSV field only when it needs it (same rule as csv's QUOTE_MINIMAL)."""
+    if '"' in value or ',' in value or '\n' in value or '\r' in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+def _open_user_log_file(path: str) -> Union[BinaryIO, None]:
+    # User-log I/O is best-effort: a file that can't be opened is logged and left disabled (None)
+    # instead of failing the bot's start-up.
+    try:
+        # Binary: the writer encodes each joined batch once instead of going through TextIOWrapper per write
+        return open(path, "ab", buffering=1 << 16)
+    except OSError as e:
+        logger.error("[USER_INPUT_HANDLER] Cannot open '%s'; logging to it is disabled: %s", path, e)
+        return None
+
+def _open_user_log_files() -> None:
+    global _user_log_fh, _user_rows_fh
+    _user_log_fh = _open_user_log_file(USER_MESSAGES_LOGFILE)
+    _user_rows_fh = _open_user_log_file(_USER_INPUTS_FILE)
+    if _user_rows_fh is not None and _USER_INPUTS_AS_CSV and _user_rows_fh.tell() == 0: # New or empty CSV: header goes first, once
+        try:
+            _user_rows_fh.write(_CSV_HEADER)
+        except OSError as e:
+            logger.error("[USER_INPUT_HANDLER] Error writing CSV header to '%s': %s", _USER_INPUTS_FILE, e)
+
+def _close_user_log_files() -> None:
+    global _user_log_fh, _user_rows_fh
+    for fh in (_user_log_fh, _user_rows_fh):
+        if fh is not None:
+            fh.close()
+    _user_log_fh = _user_rows_fh = None
+
+def _flush_user_log_files() -> None:
+    """Runs on _user_log_executor; never raises."""
+    global _user_log_pending_bytes
+    try:
+        for fh in (_user_log_fh, _user_rows_fh):
+            if fh is not None:
+                fh.flush()
+        _user_log_pending_bytes = 0
+    except Exception as e:
+        logger.error("[USER_INPUT_HANDLER] Error flushing '%s' / '%s': %s", USER_MESSAGES_LOGFILE, _USER_INPUTS_FILE, e)
+
+def _write_user_log_batch(batch: List[Tuple[str, bytes]]) -> None:
+    """Runs on _user_log_executor; never raises."""
+    global _user_log_pending_bytes
+    try:
+        lines = b""
+        rows = b""
+        if _user_log_fh is not None: # None: the file could not be opened at start-up
+            lines = "".join(line for line, _ in batch).encode("utf-8")
+            _user_log_fh.write(lines)
+        if _user_rows_fh is not None:
+            rows = b"".join(row for _, row in batch)
+            _user_rows_fh.write(rows)
+    except Exception as e:
+        logger.error("[USER_INPUT_HANDLER] Error writing %d user message(s) to '%s' / '%s': %s", len(batch), USER_MESSAGES_LOGFILE, _USER_INPUTS_FILE, e)
+        return
+    # No flush per batch: the ticker flushes on an interval, this only on a burst
+    _user_log_pending_bytes += len(lines) + len(rows)
+    if _user_log_pending_bytes >= _USER_LOG_FLUSH_BYTES:
+        _flush_user_log_files()
+
+def _finish_user_log_files(batches: List[List[Tuple[str, bytes]]]) -> None:
+    """Runs on _user_log_executor at shutdown: writes what was still queued, then closes the files."""
+    for batch in batches:
+        _write_user_log_batch(batch)
+    _close_user_log_files()
+
+def _take_user_log_batch(first: Union[Tuple[str, bytes], None] = None) -> List[Tuple[str, bytes]]:
+    batch = [first] if first is not None else []
+    while len(batch) < _USER_LOG_BATCH_MAX and not _user_log_queue.empty():
+        batch.append(_user_log_queue.get_nowait())
+    return batch
+
+async def _user_log_flusher() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = _take_user_log_batch(await _user_log_queue.get())
+        await loop.run_in_executor(_user_log_executor, _write_user_log_batch, batch)
+
+async def _user_log_flush_ticker() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(_USER_LOG_FLUSH_INTERVAL_S)
+        if _user_log_pending_bytes: # Flushed on the writer thread, so it never races a write
+            await loop.run_in_executor(_user_log_executor, _flush_user_log_files)
+
+async def start_user_log_flusher(application: Application) -> None:
+    """post_init hook: opens the user message log files and starts their background writer and flush ticker."""
+    global _user_log_flusher_task, _user_log_ticker_task, _user_log_executor
+    _user_log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-log-writer")
+    _open_user_log_files()
+    _user_log_flusher_task = asyncio.create_task(_user_log_flusher())
+    _user_log_ticker_task = asyncio.create_task(_user_log_flush_ticker())
+
+async def stop_user_log_flusher(application: Application) -> None:
+    """post_shutdown hook: stops the writer, flushes anything still queued and closes the files."""
+    global _user_log_executor
+    for task in (_user_log_flusher_task, _user_log_ticker_task):
+        if task is not None:
+            task.cancel()
+    executor = _user_log_executor
+    if executor is None:
+        return
+    # The queue is drained here on the loop thread; writing and closing run on the writer thread,
+    # queued behind any in-flight batch (single worker), and are awaited rather than blocked on.
+    batches = []
+    while not _user_log_queue.empty():
+        batches.append(_take_user_log_batch())
+    await asyncio.get_running_loop().run_in_executor(executor, _finish_user_log_files, batches)
+    executor.shutdown(wait=False)
+    _user_log_executor = None
 
 
 async def handle_user_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles non-command text messages from users.
-    Logs the message to a .log file and a .csv file.
+    Logs the message to a .log file and a structured .csv (or, opted in, .jsonl) file.
     Forwards the message to the admin if it contains specific keywords.
     """
-    # Ensure there's a message and text content
-    if not update.message or not update.message.text:
-        if hasattr(context, 'logger') and context.logger:
-            context.logger.warning("[USER_INPUT_HANDLER] Received an update without message or message text.")
-        else:
-            print("[USER_INPUT_HANDLER] WARNING: Received an update without message or message text.")
+    # Ensure there's a message and text content; everything below uses these locals only
+    msg = update.message
+    if msg is None or not msg.text:
+        logger.warning("[USER_INPUT_HANDLER] Received an update without message or message text.")
         return
 
-    user = update.effective_user
-    if not user:
-        if hasattr(context, 'logger') and context.logger:
-            context.logger.warning("[USER_INPUT_HANDLER] Received a message without an effective_user.")
-        else:
-            print("[USER_INPUT_HANDLER] WARNING: Received a message without an effective_user.")
+    user = msg.from_user # Same as effective_user here (the filter only passes plain messages)
+    if user is None:
+        logger.warning("[USER_INPUT_HANDLER] Received a message without an effective_user.")
         return
-        
+
     user_id = user.id
-    username = user.username if user.username else "N/A" # Handle cases where username might be None
-    message_text = update.message.text
-    timestamp_utc = datetime.utcnow()
-    timestamp_str_log = timestamp_utc.strftime('%Y-%m-%d %H:%M:%S UTC') # For .log file
-    timestamp_iso_csv = timestamp_utc.isoformat() # For .csv file
-
-    # --- Ensure logs directory exists ---
-    log_dir = os.path.dirname(USER_MESSAGES_LOGFILE) # Assumes USER_MESSAGES_LOGFILE includes 'logs/' path
-    if not log_dir: # Handle case where USER_MESSAGES_LOGFILE might be just a filename
-        log_dir = "logs" # Default to "logs" if path part is missing
-    
-    try:
-        os.makedirs(log_dir, exist_ok=True)
-    except OSError as e:
-        if hasattr(context, 'logger') and context.logger:
-            context.logger.error(f"[USER_INPUT_HANDLER] Error creating logs directory '{log_dir}': {e}")
-        else:
-            print(f"[USER_INPUT_HANDLER] ERROR: Error creating logs directory '{log_dir}': {e}")
-        # Decide if you want to return or continue without logging if dir creation fails
-        # For now, we'll attempt to log anyway, which might fail if dir doesn't exist.
-
-    # --- Write to .log file (Solution C - Part 1) ---
-    try:
-        with open(USER_MESSAGES_LOGFILE, "a", encoding="utf-8") as f:
-            f.write(f"{timestamp_str_log} | UserID: {user_id} | @{username} | Message: {message_text}\n")
-        if hasattr(context, 'logger') and context.logger:
-            context.logger.info(f"[USER_INPUT_LOG] UserID: {user_id}, @{username}, Message logged to .log: '{message_text[:70]}...'")
-        else:
-            print(f"[USER_INPUT_LOG] UserID: {user_id}, @{username}, Message logged to .log: '{message_text[:70]}...'")
-    except Exception as e:
-        if hasattr(context, 'logger') and context.logger:
-            context.logger.error(f"[USER_INPUT_HANDLER] Error writing to .log file '{USER_MESSAGES_LOGFILE}': {e}")
-        else:
-            print(f"[USER_INPUT_HANDLER] ERROR: Error writing to .log file '{USER_MESSAGES_LOGFILE}': {e}")
+    username = user.username or "N/A" # Handle cases where username might be None
+    message_text = msg.text
+    timestamp_str_log, timestamp_iso = _utc_timestamps() # For .log file / structured row
 
-    # --- Write to .csv file (Solution C - Part 2) ---
+    # --- Queue for the .log and .csv/.jsonl files (Solution C); written in batches by _user_log_flusher ---
     try:
-        # Ensure the directory for CSV also exists
-        csv_dir = os.path.dirname(USER_INPUTS_CSVFILE)
-        if not csv_dir:
-            csv_dir = "logs"
-        os.makedirs(csv_dir, exist_ok=True)
-
-        file_exists = os.path.isfile(USER_INPUTS_CSVFILE)
-        fieldnames_csv = ["timestamp_iso", "user_id", "username", "message_text"] # Renamed for clarity
-
-        with open(USER_INPUTS_CSVFILE, "a", newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames_csv)
-            if not file_exists or os.path.getsize(USER_INPUTS_CSVFILE) == 0: # Check if file is empty too
-                writer.writeheader()
-            writer.writerow({
-                "timestamp_iso": timestamp_iso_csv,
-                "user_id": user_id,
-                "username": username,
-                "message_text": message_text
-            })
-        # Optional log for CSV writing
-        # if hasattr(context, 'logger') and context.logger:
-        #     context.logger.info(f"[USER_INPUT_CSV] UserID: {user_id}, @{username}, Message logged to .csv.")
-    except Exception as e:
-        if hasattr(context, 'logger') and context.logger:
-            context.logger.error(f"[USER_INPUT_HANDLER] Error writing to .csv file '{USER_INPUTS_CSVFILE}': {e}")
-        else:
-            print(f"[USER_INPUT_HANDLER] ERROR: Error writing to .csv file '{USER_INPUTS_CSVFILE}': {e}")
+        _user_log_queue.put_nowait((
+            f"{timestamp_str_log} | UserID: {user_id} | @{username} | Message: {message_text}\n",
+            # CSV: timestamp, numeric ID and Telegram usernames ([A-Za-z0-9_]) never need quoting
+            f"{timestamp_iso},{user_id},{username},{_csv_escape(message_text)}\r\n".encode("utf-8")
+            if _USER_INPUTS_AS_CSV else
+            _json_line({"ts": timestamp_iso, "uid": user_id, "un": username, "msg": message_text}),
+        ))
+    except asyncio.QueueFull:
+        _note_user_log_drop() # Forwarding below still runs
+    else:
+        if logger.isEnabledFor(logging.INFO): # Skip the slice when INFO is off
+            logger.info("[USER_INPUT_LOG] UserID: %s, @%s, Message queued for user logs: '%s...'", user_id, username, message_text[:70])
 
     # --- Conditional Forwarding to Admin (Solution A Variant) ---
-    if ADMIN_TELEGRAM_ID: # Only attempt to forward if ADMIN_TELEGRAM_ID is set
-        message_lower = message_text.lower()
-        # Ensure USER_MESSAGE_FORWARD_KEYWORDS is a list/iterable
-        keywords_to_check = USER_MESSAGE_FORWARD_KEYWORDS if isinstance(USER_MESSAGE_FORWARD_KEYWORDS, (list, tuple, set)) else []
-        
-        if any(keyword.lower() in message_lower for keyword in keywords_to_check):
+    if _FORWARD_ENABLED:
+        if _KW_RE.search(message_text):
             try:
-                forward_text = (
-                    f"📥 **User Message Alert** (Keyword Triggered)\n\n"
-                    f"👤 **User:** @{username} (ID: `{user_id}`)\n"
-                    # f"🕒 **Time (UTC):** {timestamp_str_log}\n\n" # Optional timestamp in forward
-                    f"💬 **Message:**\n`{message_text}`" # Using markdown for formatting
+                forward_text = _FORWARD_TEMPLATE.format(
+                    username=username, user_id=user_id, message=html.escape(message_text, quote=False)
                 )
                 await context.bot.send_message(
                     chat_id=ADMIN_TELEGRAM_ID,
                     text=forward_text,
-                    parse_mode='MarkdownV2' # Or 'HTML' if you prefer
+                    parse_mode=ParseMode.HTML
                 )
-                if hasattr(context, 'logger') and context.logger:
-                    context.logger.info(f"[ADMIN_FORWARD] Message from UserID: {user_id} (@{username}) forwarded to admin due to keyword match.")
-                else:
-                    print(f"[ADMIN_FORWARD] Message from UserID: {user_id} (@{username}) forwarded to admin due to keyword match.")
+                logger.info("[ADMIN_FORWARD] Message from UserID: %s (@%s) forwarded to admin due to keyword match.", user_id, username)
             except Exception as e:
-                if hasattr(context, 'logger') and context.logger:
-                    context.logger.error(f"[ADMIN_FORWARD] Error forwarding message to admin {ADMIN_TELEGRAM_ID}: {e}")
-                else:
-                    print(f"[ADMIN_FORWARD] ERROR: Error forwarding message to admin {ADMIN_TELEGRAM_ID}: {e}")
+                logger.error("[ADMIN_FORWARD] Error forwarding message to admin %s: %s", ADMIN_TELEGRAM_ID, e)
         # else: # Optional: Log if no keyword match for debugging forward logic
-            # if hasattr(context, 'logger') and context.logger:
-            #     context.logger.debug(f"[ADMIN_FORWARD] Message from UserID: {user_id} did not match keywords for forwarding.")
-    else:
-        if hasattr(context, 'logger') and context.logger:
-            context.logger.warning("[ADMIN_FORWARD] ADMIN_TELEGRAM_ID not set. Cannot forward user messages.")
-        else:
-            print("[ADMIN_FORWARD] WARNING: ADMIN_TELEGRAM_ID not set. Cannot forward user messages.")
+            # logger.debug("[ADMIN_FORWARD] Message from UserID: %s did not match keywords for forwarding.", user_id)
 
     # Note on further processing:
     # If this handler is meant to be a final catch-all for text messages that aren't handled by
@@ -1,46 +1,68 @@
 # start_bot.py
 
+import atexit
 import logging
+import logging.handlers
 import os
 import asyncio
+import queue
 
-from telegram import Update # Keep for consistency
+from dotenv import load_dotenv
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters # Added MessageHandler and filters
-
-# --- CRITICAL IMPORT: From handlers.step_1 ---
-# Only the main flow function is needed as the button is a URL link
-from handlers.step_1 import start_main_unified_flow
-# No callback handler or callback data constant needed from step_1.py if URL button is used
-
-# AI_MODIFIED_BLOCK_START: Import the new user input handler
-from handlers.user_input_handler import handle_user_text_message
-# AI_MODIFIED_BLOCK_END
-
-# --- Environment Variable Logging ---
-print(f"CRITICAL_ENV_PRINT_AT_TOP: RENDER_EXTERNAL_URL='{os.environ.get('RENDER_EXTERNAL_URL')}'")
-print(f"CRITICAL_ENV_PRINT_AT_TOP: APP_ENV='{os.environ.get('APP_ENV')}'")
-print(f"CRITICAL_ENV_PRINT_AT_TOP: PORT='{os.environ.get('PORT')}'")
-print(f"CRITICAL_ENV_PRINT_AT_TOP: TELEGRAM_BOT_TOKEN_EXISTS='{'SET' if os.environ.get('TELEGRAM_BOT_TOKEN') else 'NOT_SET'}'")
-print(f"CRITICAL_ENV_PRINT_AT_TOP: Z1_GRAY_SALT_EXISTS='{'SET' if os.environ.get('Z1_GRAY_SALT') else 'NOT_SET'}'")
+from telegram.request import HTTPXRequest
+
+# Optional: faster decoding of Bot API responses (see _OrjsonHTTPXRequest)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# --- Environment (read once; the process environment does not change after start) ---
+# Load the project-root .env (local development) before the snapshot below; existing variables win.
+# config.settings loads the same file, but it is only imported later, inside main().
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+ENV = {k: os.environ.get(k) for k in (
+    "RENDER_EXTERNAL_URL", "APP_ENV", "PORT", "WEBHOOK_PORT", "WEBHOOK_LISTEN_IP",
+    "WEBHOOK_PATH", "TELEGRAM_BOT_TOKEN", "Z1_GRAY_SALT", "BOT_VERSION", "LOG_LEVEL",
+)}
 
 # --- Logging Configuration ---
+LOG_LEVEL = (ENV["LOG_LEVEL"] or "INFO").upper()
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=os.environ.get("LOG_LEVEL", "INFO").upper()
+    level=LOG_LEVEL,
+    force=True # Replace, never stack, handlers if this module is imported again (tests, reloaders)
 )
+# Hand records to a background thread: handlers on the event loop only enqueue, and the stream
+# write (and its handler lock) happens on the listener thread.
+_root_logger = logging.getLogger()
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, *_root_logger.handlers, respect_handler_level=True)
+_root_logger.handlers = [logging.handlers.QueueHandler(_log_queue)]
+_log_listener.start()
+atexit.register(_log_listener.stop) # Flushes queued records on exit
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("telegram.ext").setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
+# --- Environment Variable Logging ---
+if logger.isEnabledFor(logging.INFO):
+    logger.info(
+        "Env snapshot: RENDER_EXTERNAL_URL='%s', APP_ENV='%s', PORT='%s', TELEGRAM_BOT_TOKEN=%s, Z1_GRAY_SALT=%s",
+        ENV['RENDER_EXTERNAL_URL'], ENV['APP_ENV'], ENV['PORT'],
+        'SET' if ENV['TELEGRAM_BOT_TOKEN'] else 'NOT_SET',
+        'SET' if ENV['Z1_GRAY_SALT'] else 'NOT_SET',
+    )
+
 # --- BOT Configuration ---
-BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+BOT_TOKEN = ENV["TELEGRAM_BOT_TOKEN"]
 if not BOT_TOKEN:
     logger.critical("FATAL: TELEGRAM_BOT_TOKEN environment variable not set!")
     exit(1)
 
-BOT_VERSION = os.environ.get("BOT_VERSION", "2.2.1-final-perception") # Updated version
-APP_ENV = os.environ.get("APP_ENV", "development").lower()
-WEBHOOK_URL_BASE_FROM_ENV = os.environ.get("RENDER_EXTERNAL_URL")
+BOT_VERSION = ENV["BOT_VERSION"] or "2.2.1-final-perception" # Updated version
+APP_ENV = (ENV["APP_ENV"] or "development").lower()
+WEBHOOK_URL_BASE_FROM_ENV = ENV["RENDER_EXTERNAL_URL"]
 
 # --- Webhook/Polling URL Configuration ---
 if APP_ENV == "production":
@@ -48,30 +70,94 @@ if APP_ENV == "production":
         logger.critical("FATAL: RENDER_EXTERNAL_URL is MISSING for production on Render!")
         exit(1)
     if not WEBHOOK_URL_BASE_FROM_ENV.startswith("https://"):
-        logger.critical(f"FATAL: RENDER_EXTERNAL_URL ('{WEBHOOK_URL_BASE_FROM_ENV}') must be an HTTPS URL!")
+        logger.critical("FATAL: RENDER_EXTERNAL_URL ('%s') must be an HTTPS URL!", WEBHOOK_URL_BASE_FROM_ENV)
         exit(1)
     WEBHOOK_URL_BASE = WEBHOOK_URL_BASE_FROM_ENV
 else:
     WEBHOOK_URL_BASE = WEBHOOK_URL_BASE_FROM_ENV if WEBHOOK_URL_BASE_FROM_ENV else "http://localhost.placeholder.for.dev"
-    logger.info(f"Development mode. WEBHOOK_URL_BASE (may be placeholder): {WEBHOOK_URL_BASE}")
+    logger.info("Development mode. WEBHOOK_URL_BASE (may be placeholder): %s", WEBHOOK_URL_BASE)
 
-WEBHOOK_PATH_SEGMENT = "webhook_z1_gray"
-logger.info(f"Using webhook path segment: '{WEBHOOK_PATH_SEGMENT}'")
-_cleaned_base = WEBHOOK_URL_BASE.rstrip('/')
-_cleaned_segment = WEBHOOK_PATH_SEGMENT.lstrip('/')
-FULL_WEBHOOK_URL_FOR_TELEGRAM = f"{_cleaned_base}/{_cleaned_segment}" if _cleaned_segment else _cleaned_base
+WEBHOOK_PATH_SEGMENT = (ENV["WEBHOOK_PATH"] or "webhook_z1_gray").strip("/") # Override per deployment instead of per-copy edits
+if not WEBHOOK_PATH_SEGMENT:
+    logger.critical("FATAL: WEBHOOK_PATH ('%s') must contain a path segment, not only slashes!", ENV["WEBHOOK_PATH"])
+    exit(1)
+logger.info("Using webhook path segment: '%s'", WEBHOOK_PATH_SEGMENT)
+FULL_WEBHOOK_URL_FOR_TELEGRAM = f"{WEBHOOK_URL_BASE.rstrip('/')}/{WEBHOOK_PATH_SEGMENT}"
 
 DEFAULT_LOCAL_PORT = 8443
-PORT = int(os.environ.get("PORT", os.environ.get("WEBHOOK_PORT", DEFAULT_LOCAL_PORT)))
-ALLOWED_UPDATES_TYPES_STR_LIST = ["message", "callback_query"] # Keep callback_query if any other callbacks exist
+PORT = int(ENV["PORT"] or ENV["WEBHOOK_PORT"] or DEFAULT_LOCAL_PORT)
+WEBHOOK_LISTEN_IP = ENV["WEBHOOK_LISTEN_IP"] or "0.0.0.0"
+# Concurrent HTTPS connections Telegram may open to the webhook listener (Bot API default 40, max 100)
+WEBHOOK_MAX_CONNECTIONS = 100
+ALLOWED_UPDATES_TYPES = ("message", "callback_query") # Keep callback_query if any other callbacks exist
+
+# --- Outbound HTTP Configuration ---
+# All Bot API traffic goes to one host, so HTTP/2 multiplexes concurrent calls over a single TLS
+# connection instead of opening one per request. getUpdates (polling) gets its own small pool so a
+# long poll never holds a slot the senders need. Requires the `http2` extra (see requirements.txt).
+API_HTTP_VERSION = "2"
+API_CONNECTION_POOL_SIZE = 256
+API_POOL_TIMEOUT_S = 5.0
+GET_UPDATES_CONNECTION_POOL_SIZE = 4
+
+class _OrjsonHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Bot API responses (incl. getUpdates batches) with orjson."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes):
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # e.g. invalid UTF-8: the stdlib path decodes with "replace" and raises TelegramError if still bad
+            return HTTPXRequest.parse_json_payload(payload)
+
+_REQUEST_CLASS = _OrjsonHTTPXRequest if orjson is not None else HTTPXRequest
+
+# Updates are handled concurrently (bounded), so one slow send doesn't hold up other users' taps.
+# Updates from the same user can overlap too: handlers that must not run twice at once guard
+# themselves with a FlowState marker set before their first await (e.g. Step 2's s2_scan_running).
+CONCURRENT_UPDATES = 256
 
 def main() -> None:
-    logger.info(f"--- Starting Z1-Gray Bot (Version: {BOT_VERSION}) ---")
-    logger.info(f"Application Environment (APP_ENV): {APP_ENV}")
-    logger.info(f"Effective Port for Listener: {PORT}")
-    logger.info(f"Bot Token Suffix: ...{BOT_TOKEN[-4:]}")
+    logger.info("--- Starting Z1-Gray Bot (Version: %s) ---", BOT_VERSION)
+    logger.info("Application Environment (APP_ENV): %s", APP_ENV)
+    logger.info("Effective Port for Listener: %s", PORT)
+    logger.info("Bot Token Suffix: ...%s", BOT_TOKEN[-4:])
+
+    # Handler modules are imported here, after the env checks above have had a chance to exit(1),
+    # so a misconfigured boot fails fast (and their import-time logs go through the configured handlers).
+    # --- CRITICAL IMPORT: From handlers.step_1 ---
+    # Only the main flow function is needed as the button is a URL link
+    from handlers.step_1 import start_main_unified_flow
+    # No callback handler or callback data constant needed from step_1.py if URL button is used
+
+    # AI_MODIFIED_BLOCK_START: Import the new user input handler
+    from handlers.user_input_handler import handle_user_text_message, start_user_log_flusher, stop_user_log_flusher
+    # AI_MODIFIED_BLOCK_END
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    # libuv-backed event loop when available (not on Windows); PTB's run_* then run on it
+    if os.name != "nt":
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.info("Using uvloop event loop policy.")
+        except ImportError:
+            logger.info("uvloop not installed; using the default asyncio event loop.")
+
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(_REQUEST_CLASS(
+            connection_pool_size=API_CONNECTION_POOL_SIZE, pool_timeout=API_POOL_TIMEOUT_S, http_version=API_HTTP_VERSION
+        ))
+        .get_updates_request(_REQUEST_CLASS(
+            connection_pool_size=GET_UPDATES_CONNECTION_POOL_SIZE, http_version=API_HTTP_VERSION
+        ))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(start_user_log_flusher) # Batched writer for user message logs
+        .post_shutdown(stop_user_log_flusher) # ...and its final flush
+        .build()
+    )
 
     # --- Register Handlers ---
     application.add_handler(CommandHandler("start", start_main_unified_flow))
@@ -85,8 +171,9 @@ def main() -> None:
     # This handler will catch any text message that is NOT a command.
     # It's generally good practice to add more general handlers (like this MessageHandler for text)
     # after more specific ones (like CommandHandlers or other specific MessageHandlers/ConversationHandlers).
+    # Edits are excluded so a message is logged/forwarded once, not again per edit
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_user_text_message)
+        MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.UpdateType.EDITED_MESSAGE, handle_user_text_message)
     )
     logger.info("Registered user_input_handler for general text messages.")
     # AI_MODIFIED_BLOCK_END
@@ -94,44 +181,31 @@ def main() -> None:
     # --- Webhook/Polling Start Logic ---
     try:
         if APP_ENV == "production":
-            logger.info(f"Production mode: Initializing webhook application.")
-            logger.info(f"  Listener will be on: {os.environ.get('WEBHOOK_LISTEN_IP', '0.0.0.0')}:{PORT}")
-            logger.info(f"  Internal URL path for PTB: /{WEBHOOK_PATH_SEGMENT}")
-            logger.info(f"  Public Webhook URL for Telegram API: {FULL_WEBHOOK_URL_FOR_TELEGRAM}")
+            logger.info("Production mode: Initializing webhook application.")
+            logger.info("  Listener will be on: %s:%s", WEBHOOK_LISTEN_IP, PORT)
+            logger.info("  Internal URL path for PTB: /%s", WEBHOOK_PATH_SEGMENT)
+            logger.info("  Public Webhook URL for Telegram API: %s", FULL_WEBHOOK_URL_FOR_TELEGRAM)
             application.run_webhook(
-                listen=os.environ.get("WEBHOOK_LISTEN_IP", "0.0.0.0"),
+                listen=WEBHOOK_LISTEN_IP,
                 port=PORT,
                 url_path=WEBHOOK_PATH_SEGMENT,
                 webhook_url=FULL_WEBHOOK_URL_FOR_TELEGRAM,
-                allowed_updates=ALLOWED_UPDATES_TYPES_STR_LIST,
-                drop_pending_updates=True
+                allowed_updates=list(ALLOWED_UPDATES_TYPES),
+                drop_pending_updates=True,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
             )
         else: 
-            logger.info(f"Development mode: Initializing polling application.")
-            async def _clear_webhook_for_dev(app: Application):
-                logger.info("Attempting to clear any existing webhook for development polling...")
-                try:
-                    await app.bot.delete_webhook(drop_pending_updates=True)
-                    logger.info("Webhook cleared successfully for dev polling.")
-                except Exception as e_del_wh:
-                    logger.warning(f"Could not delete webhook in dev mode (this is often OK): {e_del_wh}")
-
-            try:
-                loop = asyncio.get_running_loop()
-                asyncio.ensure_future(_clear_webhook_for_dev(application), loop=loop)
-            except RuntimeError: 
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                loop.run_until_complete(_clear_webhook_for_dev(application))
-            
+            logger.info("Development mode: Initializing polling application.")
+            # No separate webhook clear: run_polling's bootstrap already calls delete_webhook
+            # (with drop_pending_updates) on the application's own loop before the first getUpdates.
             application.run_polling(
-                allowed_updates=ALLOWED_UPDATES_TYPES_STR_LIST,
+                allowed_updates=list(ALLOWED_UPDATES_TYPES),
                 drop_pending_updates=True
             )
     except Exception as e:
-        logger.critical(f"CRITICAL ERROR during bot main execution loop: {e}", exc_info=True)
+        logger.critical("CRITICAL ERROR during bot main execution loop: %s", e, exc_info=True)
     finally:
-        logger.info(f"--- Z1-Gray Bot (Version: {BOT_VERSION}) application run loop has concluded. ---")
+        logger.info("--- Z1-Gray Bot (Version: %s) application run loop has concluded. ---", BOT_VERSION)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
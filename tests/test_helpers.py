@@ -0,0 +1,120 @@
+import asyncio
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+
+from utils.helpers import (
+    _MAX_COALESCED_TEXT_LEN,
+    TimedMessage,
+    _TokenBucket,
+    coalesce_timed_messages,
+    drop_unneeded_html_parse_mode,
+)
+
+_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Go", callback_data="go")]])
+
+
+# --- coalesce_timed_messages ---
+
+def test_coalesce_merges_same_group_and_sums_delays():
+    merged = coalesce_timed_messages((
+        TimedMessage("a", delay_before=1.0, group=1),
+        TimedMessage("b", delay_before=2.0, group=1),
+    ))
+    assert len(merged) == 1
+    assert merged[0].text == "a\n\nb"
+    assert merged[0].delay_before == 3.0
+
+def test_coalesce_keeps_ungrouped_and_different_groups_apart():
+    sequence = (
+        TimedMessage("a"),
+        TimedMessage("b"),
+        TimedMessage("c", group=1),
+        TimedMessage("d", group=2),
+    )
+    assert coalesce_timed_messages(sequence) == sequence
+
+def test_coalesce_respects_text_length_limit():
+    first = TimedMessage("x" * (_MAX_COALESCED_TEXT_LEN - 10), group=1)
+    second = TimedMessage("y" * 10, group=1) # Fits alone, not after the "\n\n" join
+    assert coalesce_timed_messages((first, second)) == (first, second)
+
+def test_coalesce_requires_matching_parse_mode():
+    sequence = (
+        TimedMessage("a", parse_mode=ParseMode.HTML, group=1),
+        TimedMessage("b", parse_mode=None, group=1),
+    )
+    assert coalesce_timed_messages(sequence) == sequence
+
+def test_coalesce_keyboard_only_on_the_later_item():
+    with_keyboard_first = (
+        TimedMessage("a", reply_markup=_MARKUP, group=1),
+        TimedMessage("b", group=1),
+    )
+    assert coalesce_timed_messages(with_keyboard_first) == with_keyboard_first
+
+    merged = coalesce_timed_messages((
+        TimedMessage("a", group=1),
+        TimedMessage("b", reply_markup=_MARKUP, group=1),
+    ))
+    assert len(merged) == 1
+    assert merged[0].reply_markup is _MARKUP
+
+def test_coalesce_allows_at_most_one_system_log():
+    both = (
+        TimedMessage("a", system_log="first", group=1),
+        TimedMessage("b", system_log="second", group=1),
+    )
+    assert coalesce_timed_messages(both) == both
+
+    merged = coalesce_timed_messages((
+        TimedMessage("a", group=1),
+        TimedMessage("b", system_log="second", group=1),
+    ))
+    assert len(merged) == 1
+    assert merged[0].system_log == "second"
+
+
+# --- drop_unneeded_html_parse_mode ---
+
+def test_drop_html_parse_mode_only_for_plain_text():
+    plain, tagged, entity, field = drop_unneeded_html_parse_mode((
+        TimedMessage("plain text"),
+        TimedMessage("<b>bold</b>"),
+        TimedMessage("a &amp; b"),
+        TimedMessage("Hello {username}"),
+    ))
+    assert plain.parse_mode is None
+    assert tagged.parse_mode == ParseMode.HTML
+    assert entity.parse_mode == ParseMode.HTML
+    assert field.parse_mode == ParseMode.HTML
+
+
+# --- _TokenBucket ---
+
+def test_token_bucket_spends_burst_then_waits():
+    async def run():
+        bucket = _TokenBucket(rate=20.0, capacity=2)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for _ in range(3):
+            await bucket.acquire()
+        return loop.time() - start, bucket.waiting
+
+    elapsed, waiting = asyncio.run(run())
+    assert elapsed >= 0.04 # The third call waits for a refill (1 / 20 s, minus timer slack)
+    assert waiting == 0
+
+def test_token_bucket_counts_waiting_callers():
+    async def run():
+        bucket = _TokenBucket(rate=10.0, capacity=1)
+        await bucket.acquire()
+        pending = [asyncio.create_task(bucket.acquire()) for _ in range(3)]
+        await asyncio.sleep(0)
+        during = bucket.waiting
+        await asyncio.gather(*pending)
+        return during, bucket.waiting
+
+    during, after = asyncio.run(run())
+    assert during == 3
+    assert after == 0
@@ -0,0 +1,39 @@
+import csv
+import io
+import json
+
+import pytest
+
+from handlers.user_input_handler import _csv_escape, _json_line
+
+
+def _csv_writer_field(value: str) -> str:
+    buf = io.StringIO()
+    csv.writer(buf).writerow(["x", value])
+    return buf.getvalue()[len("x,"):-len("\r\n")]
+
+
+@pytest.mark.parametrize("value", [
+    "plain",
+    "",
+    "with, comma",
+    'with "quotes"',
+    "line\nbreak",
+    "carriage\rreturn",
+    'all, of "them"\r\n',
+    "héllo 👋",
+])
+def test_csv_escape_matches_csv_writer(value):
+    assert _csv_escape(value) == _csv_writer_field(value)
+
+def test_csv_escape_round_trips_through_csv_reader():
+    value = 'a, "b"\nc'
+    row = f"2024-01-01T00:00:00Z,42,someone,{_csv_escape(value)}\r\n"
+    assert next(csv.reader(io.StringIO(row, newline=""))) == ["2024-01-01T00:00:00Z", "42", "someone", value]
+
+def test_json_line_is_one_utf8_line():
+    record = {"ts": "2024-01-01T00:00:00Z", "uid": 42, "un": "someone", "msg": 'héllo "x"\nnext'}
+    line = _json_line(record)
+    assert line.endswith(b"\n")
+    assert line.count(b"\n") == 1
+    assert json.loads(line.decode("utf-8")) == record
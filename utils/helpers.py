@@ -2,18 +2,21 @@
 
 import asyncio
 import logging
-import datetime
-import hashlib
+import functools
 import os
 import random
-from dataclasses import dataclass, field # field might not be used here but often imported
-from typing import List, Union, Callable, Any, Coroutine, Tuple, Dict # Added more common types
+from collections import OrderedDict
+from hashlib import blake2b as _blake2b # Bound once; skips the module attribute lookup per call
+from dataclasses import dataclass, field, replace # field might not be used here but often imported
+from typing import List, Union, Callable, Any, Coroutine, Tuple, Dict, Mapping, Sequence # Added more common types
 
 from telegram import Update, CallbackQuery, Message # For type hinting
 from telegram.constants import ChatAction, ParseMode
 from telegram.ext import ContextTypes
 from telegram.error import TelegramError, RetryAfter, TimedOut, NetworkError # Specific errors
 
+from utils.state_definitions import FLOW_STATE_KEY
+
 logger = logging.getLogger(__name__)
 
 # --- Environment Variables & Constants ---
@@ -22,6 +25,7 @@ if _Z1_GRAY_SALT == "DEFAULT_FALLBACK_SALT_CHANGE_ME_XYZ123":
     logger.warning("SECURITY WARNING: Using default Z1_GRAY_SALT. Please set a unique Z1_GRAY_SALT environment variable.")
 
 # --- ID Generation ---
+@functools.lru_cache(maxsize=65536) # Users re-enter /start often; repeat lookups skip the hash entirely
 def generate_user_secure_id(user_id: int) -> str:
     """
     Generates a 16-character uppercase hex string based on Telegram user_id and salt.
@@ -29,20 +33,178 @@ def generate_user_secure_id(user_id: int) -> str:
     """
     # Using a prefix in the hash input for better salt mixing, even if not strictly necessary for this case
     combined_string = f"Z1_USER_ID_RAW_{user_id}_{_Z1_GRAY_SALT}"
-    hash_object = hashlib.sha256(combined_string.encode('utf-8'))
-    return hash_object.hexdigest()[:16].upper()
+    # BLAKE2b with an 8-byte digest yields exactly 16 hex chars, no truncation needed
+    hash_object = _blake2b(combined_string.encode('utf-8'), digest_size=8)
+    return hash_object.hexdigest().upper()
 
 # Note: _generate_internal_flow_id was kept in handlers/step_1.py as it was specific to that flow's needs.
 # If it were more general, it could be moved here.
 
+# --- Outbound Rate Limiting ---
+# Telegram allows roughly 30 messages/s per bot and 1 message/s per chat. Throttling here,
+# before the request is made, is far cheaper than absorbing 429s and their retry_after pauses.
+GLOBAL_SEND_RATE_PER_S = 30
+CHAT_SEND_RATE_PER_S = 1
+_MAX_TRACKED_CHATS = 10_000 # LRU cap for the per-chat buckets
+
+class _TokenBucket:
+    """Minimal asyncio token bucket; `acquire()` waits until a send slot is free (FIFO)."""
+    __slots__ = ("rate", "capacity", "waiting", "_tokens", "_updated", "_lock")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.waiting = 0 # Callers currently inside acquire(); a cheap backlog gauge
+        self._tokens = capacity
+        self._updated = 0.0
+        self._lock: Union[asyncio.Lock, None] = None # Created lazily, inside the running loop
+
+    async def acquire(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        self.waiting += 1
+        try:
+            async with self._lock:
+                loop = asyncio.get_running_loop()
+                now = loop.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._tokens = 0.0
+                self._updated = loop.time()
+        finally:
+            self.waiting -= 1
+
+_GLOBAL_SEND_BUCKET = _TokenBucket(GLOBAL_SEND_RATE_PER_S, GLOBAL_SEND_RATE_PER_S)
+# Beyond this many queued sends, error replies are dropped rather than adding to the pile-up.
+_ERROR_REPLY_SHED_BACKLOG = 100
+_chat_send_buckets: "OrderedDict[int, _TokenBucket]" = OrderedDict()
+
+def _chat_send_bucket(chat_id: int) -> _TokenBucket:
+    bucket = _chat_send_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_send_buckets[chat_id] = _TokenBucket(CHAT_SEND_RATE_PER_S, 1)
+        if len(_chat_send_buckets) > _MAX_TRACKED_CHATS:
+            _chat_send_buckets.popitem(last=False)
+    else:
+        _chat_send_buckets.move_to_end(chat_id)
+    return bucket
+
+async def send_throttled_message(bot, chat_id: int, text: str, **kwargs: Any) -> Message:
+    """
+    `bot.send_message` behind the per-chat and process-wide rate limiters.
+    On a 429 (RetryAfter) waits the server-provided interval and retries once; other errors propagate.
+    """
+    await _chat_send_bucket(chat_id).acquire()
+    await _GLOBAL_SEND_BUCKET.acquire()
+    try:
+        return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    except RetryAfter as e_retry:
+        logger.warning("Rate limited sending to chat %s; retrying once in %ss.", chat_id, e_retry.retry_after)
+        await asyncio.sleep(e_retry.retry_after)
+        return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+async def _send_chat_action(bot, chat_id: int, action: str) -> None:
+    await _GLOBAL_SEND_BUCKET.acquire()
+    await bot.send_chat_action(chat_id=chat_id, action=action)
+
 # --- Message Sequencing & Sending ---
-@dataclass
-class TimedMessage: # This dataclass is now less used as step_1.py sends messages individually for fine ChatAction control
+@dataclass(frozen=True, slots=True) # Immutable so sequences can be shared module-level constants (Python 3.10+)
+class TimedMessage:
     text: str
     delay_before: float = 0.8
     typing: bool = True
+    chat_action: str = ChatAction.TYPING # Action shown during the delay when `typing` is set
     parse_mode: Union[str, None] = ParseMode.HTML
     reply_markup: Union[Any, None] = None
+    system_log: Union[str, None] = None # Logged after a successful send; may hold `{field}` placeholders
+    group: int = 0 # Adjacent items sharing a non-zero group are sent as one message after their summed delays (see coalesce_timed_messages)
+
+_MAX_COALESCED_TEXT_LEN = 3900 # Under Telegram's 4096-char limit, with headroom for `{field}` expansion
+
+def coalesce_timed_messages(sequence: Sequence[TimedMessage]) -> Tuple[TimedMessage, ...]:
+    """
+    Merges each item into the previous one when both carry the same non-zero `group` (the merged
+    item then waits the sum of both delays, so the sequence keeps its total pacing, and must stay
+    under _MAX_COALESCED_TEXT_LEN).
+    Texts are joined with a blank line.
+    Meant to run once at import on static sequences; each merge saves one API call.
+    Items are only merged when the result is unambiguous: same parse mode, a keyboard only on the
+    later item, and at most one system_log between them.
+    """
+    merged: List[TimedMessage] = []
+    for item in sequence:
+        prev = merged[-1] if merged else None
+        if prev is None or item.parse_mode != prev.parse_mode or prev.reply_markup is not None or (prev.system_log and item.system_log):
+            merged.append(item)
+            continue
+        text = f"{prev.text}\n\n{item.text}"
+        if item.group and item.group == prev.group and len(text) <= _MAX_COALESCED_TEXT_LEN:
+            merged[-1] = replace(
+                prev,
+                text=text,
+                delay_before=prev.delay_before + item.delay_before,
+                reply_markup=item.reply_markup,
+                system_log=prev.system_log or item.system_log,
+            )
+        else:
+            merged.append(item)
+    return tuple(merged)
+
+def drop_unneeded_html_parse_mode(sequence: Sequence[TimedMessage]) -> Tuple[TimedMessage, ...]:
+    """
+    Returns the sequence with parse_mode=None on HTML items whose text holds no markup ("<" or "&"),
+    so Telegram skips parsing them on every send. Items whose text has `{field}` placeholders keep
+    HTML: the decision must hold for the final text, and field values are not known at import.
+    Meant to run once at import on static sequences.
+    """
+    return tuple(
+        replace(item, parse_mode=None)
+        if item.parse_mode == ParseMode.HTML and "<" not in item.text and "&" not in item.text and "{" not in item.text
+        else item
+        for item in sequence
+    )
+
+async def _send_delayed_message_unguarded(
+    bot,
+    chat_id: int,
+    text: str,
+    delay_before: float,
+    show_typing: bool,
+    parse_mode: Union[str, None],
+    reply_markup: Union[Any, None],
+    disable_web_page_preview: bool,
+    chat_action: str
+) -> Message:
+    """Delay (with an overlapped chat action) then send; send errors propagate to the caller."""
+    action_task = None
+    if show_typing and delay_before > 0.2: # Only show typing if there's a noticeable delay *for this message*
+        # Fired in the background so the chat-action round trip overlaps the sleep below.
+        action_task = asyncio.ensure_future(_send_chat_action(bot, chat_id, chat_action))
+
+    if delay_before > 0:
+        await asyncio.sleep(delay_before)
+
+    send_coro = send_throttled_message(
+        bot,
+        chat_id,
+        text,
+        parse_mode=parse_mode,
+        reply_markup=reply_markup,
+        disable_web_page_preview=disable_web_page_preview
+    )
+    if action_task is None:
+        return await send_coro
+
+    action_result, message = await asyncio.gather(action_task, send_coro, return_exceptions=True)
+    if isinstance(action_result, BaseException):
+        logger.warning("Failed to send typing action to chat %s: %s", chat_id, action_result)
+    if isinstance(message, BaseException):
+        raise message
+    return message
 
 async def send_delayed_message(
     bot, # Typically context.bot
@@ -53,63 +215,82 @@ async def send_delayed_message(
     show_typing: bool = True, # Can be overridden by caller
     parse_mode: Union[str, None] = ParseMode.HTML,
     reply_markup: Union[Any, None] = None,
-    disable_web_page_preview: bool = True # Good default for system messages
+    disable_web_page_preview: bool = True, # Good default for system messages
+    chat_action: str = ChatAction.TYPING
 ) -> Union[Message, None]:
     """
     Helper to send a single message with optional delay and typing.
     The `delay_before` here is AFTER any externally controlled ChatAction delays.
-    The input_disruption_delay_s logic is handled by the caller in step_1.py.
+    The input_disruption_delay_s logic is handled by the caller in step_1.py (via send_delayed_sequence's extra_delay).
+    Returns None (after logging) if the send fails.
     """
     try:
-        if show_typing and delay_before > 0.2: # Only show typing if there's a noticeable delay *for this message*
-            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        
-        if delay_before > 0:
-            await asyncio.sleep(delay_before)
-
-        message = await bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            parse_mode=parse_mode,
-            reply_markup=reply_markup,
-            disable_web_page_preview=disable_web_page_preview
+        return await _send_delayed_message_unguarded(
+            bot, chat_id, text, delay_before, show_typing, parse_mode, reply_markup, disable_web_page_preview, chat_action
         )
-        return message
     except TelegramError as e:
-        logger.warning(f"Failed to send single delayed message to chat {chat_id}: '{text[:70]}...' due to {e}")
+        logger.warning("Failed to send single delayed message to chat %s: '%.70s...' due to %s", chat_id, text, e)
     except Exception as e_general:
-        logger.error(f"Unexpected error sending single delayed message to chat {chat_id}: '{text[:70]}...' due to {e_general}", exc_info=True)
+        logger.exception("Unexpected error sending single delayed message to chat %s: '%.70s...' due to %s", chat_id, text, e_general)
     return None
 
-# send_delayed_sequence is kept for potential future use or other parts of the bot,
-# but the main Z1-Gray flow in step_1.py now sends messages individually for precise ChatAction control.
 async def send_delayed_sequence(
     bot,
     chat_id: int,
-    sequence: List[TimedMessage],
+    sequence: Sequence[TimedMessage],
     # context: ContextTypes.DEFAULT_TYPE, # REMOVED context from here
-    initial_delay: float = 0
+    initial_delay: float = 0,
+    fields: Union[Mapping[str, Any], None] = None,
+    extra_delay: Union[Callable[[], float], None] = None
 ) -> List[Union[Message, None]]:
-    """Sends a sequence of TimedMessage objects."""
+    """
+    Sends a sequence of TimedMessage objects.
+    `sequence` is typically a module-level tuple built once at import; per-user values are passed
+    via `fields` and substituted into `{placeholder}`s in each item's text (only texts containing "{"
+    are formatted) and in its `system_log` (only when that line is actually logged).
+    `extra_delay`, if given, is called before each item; a positive result is added to that item's delay.
+    If a send fails the remaining items are skipped; their slots in the returned list are None.
+    Delays are pinned to an absolute schedule on the loop's monotonic clock, so a slow
+    API call for one message shortens the wait before the next instead of pushing it back.
+    """
     sent_messages: List[Union[Message, None]] = []
-    if initial_delay > 0:
-        await asyncio.sleep(initial_delay)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max(0.0, initial_delay)
 
-    for item in sequence:
-        sent_msg = await send_delayed_message( # context is no longer passed here
-            bot=bot,
-            chat_id=chat_id,
-            text=item.text,
-            # context=context, # REMOVED
-            delay_before=item.delay_before,
-            show_typing=item.typing,
-            parse_mode=item.parse_mode,
-            reply_markup=item.reply_markup
-        )
-        sent_messages.append(sent_msg)
+    # One guard for the whole loop: the messages are a scripted, ordered story, so after a failed
+    # send the rest is dropped rather than delivered out of context. (A single 429 is already
+    # absorbed by send_throttled_message's retry.)
+    try:
+        for item in sequence:
+            deadline += item.delay_before
+            if extra_delay is not None:
+                deadline += max(0.0, extra_delay())
+            text = item.text.format_map(fields) if fields and "{" in item.text else item.text
+            sent_msg = await _send_delayed_message_unguarded(
+                bot,
+                chat_id,
+                text,
+                delay_before=max(0.0, deadline - loop.time()),
+                show_typing=item.typing,
+                parse_mode=item.parse_mode,
+                reply_markup=item.reply_markup,
+                disable_web_page_preview=True,
+                chat_action=item.chat_action
+            )
+            sent_messages.append(sent_msg)
+            if item.system_log and logger.isEnabledFor(logging.INFO):
+                logger.info(item.system_log.format_map(fields) if fields else item.system_log)
+    except TelegramError as e:
+        logger.warning("Sequence to chat %s aborted at message %d/%d: %s", chat_id, len(sent_messages) + 1, len(sequence), e)
+    except Exception as e_general:
+        logger.exception("Unexpected error in sequence to chat %s at message %d/%d: %s", chat_id, len(sent_messages) + 1, len(sequence), e_general)
+    # Pad so callers can still index by position (e.g. check sent[-1] for the final message).
+    sent_messages.extend([None] * (len(sequence) - len(sent_messages)))
     return sent_messages
 
 # --- Error Handling ---
+_DEFAULT_ERROR_TEXT = "An unexpected system error occurred. Please try the /start sequence again or contact support if the issue persists."
+
 async def send_system_error_reply(
     target_object: Union[Update, CallbackQuery, Message, None],
     context: ContextTypes.DEFAULT_TYPE,
@@ -117,15 +298,20 @@ async def send_system_error_reply(
     error_code: str = "SYS_ERR_GEN", # More specific default error code
     custom_error_text: Union[str, None] = None
 ) -> None:
-    """Sends a standardized system error reply to the user."""
-    default_error_text = "An unexpected system error occurred. Please try the /start sequence again or contact support if the issue persists."
-    error_text_to_send = custom_error_text if custom_error_text else default_error_text
+    """
+    Sends a standardized system error reply to the user through the rate-limited send path.
+    Skipped (logged only) while the send limiter is backlogged, so error replies never add to a queue of waiting sends.
+    """
+    if _GLOBAL_SEND_BUCKET.waiting > _ERROR_REPLY_SHED_BACKLOG:
+        logger.warning("Send backlog at %d; skipping error reply for %s to user '%s'.", _GLOBAL_SEND_BUCKET.waiting, error_code, user_id_param)
+        return
+    error_text_to_send = custom_error_text if custom_error_text else _DEFAULT_ERROR_TEXT
 
     log_user_id_str = str(user_id_param)
     chat_to_send_to = None
     effective_user_telegram_id = None # Will hold the actual Telegram user ID
 
-    # Attempt to extract user_id and chat_id from the target_object
+    # One isinstance dispatch resolves the user and chat behind the target
     if isinstance(target_object, Update):
         if target_object.effective_user:
             effective_user_telegram_id = target_object.effective_user.id
@@ -148,15 +334,15 @@ async def send_system_error_reply(
     if effective_user_telegram_id:
         log_user_id_str = str(effective_user_telegram_id)
     # Fallback from context.user_data if still "Unknown" and context has it
-    elif log_user_id_str == "Unknown" and context.user_data and "user_id" in context.user_data:
-        stored_user_id = context.user_data.get("user_id")
+    elif log_user_id_str == "Unknown" and context.user_data and FLOW_STATE_KEY in context.user_data:
+        stored_user_id = context.user_data[FLOW_STATE_KEY].user_id
         if isinstance(stored_user_id, int): # Ensure it's a valid ID type
             effective_user_telegram_id = stored_user_id
             log_user_id_str = str(effective_user_telegram_id)
 
     logger.error(
-        f"ERROR_CODE: {error_code} - Sending system error reply to user_id='{log_user_id_str}', "
-        f"chat_id='{chat_to_send_to}': {error_text_to_send}"
+        "ERROR_CODE: %s - Sending system error reply to user_id='%s', chat_id='%s': %s",
+        error_code, log_user_id_str, chat_to_send_to, error_text_to_send
     )
 
     final_error_message = (
@@ -165,32 +351,22 @@ async def send_system_error_reply(
     )
 
     try:
-        # Determine the best way to reply or send the message
-        reply_candidate = None
-        if isinstance(target_object, Update) and target_object.message:
-            reply_candidate = target_object.message
-        elif isinstance(target_object, CallbackQuery) and target_object.message:
-            reply_candidate = target_object.message
-        elif isinstance(target_object, Message):
-            reply_candidate = target_object
-        
-        if reply_candidate and hasattr(reply_candidate, 'reply_html'):
-            await reply_candidate.reply_html(final_error_message)
-        elif chat_to_send_to and context.bot: # If we have a chat_id (e.g. from callback without direct message access)
-            await context.bot.send_message(chat_id=chat_to_send_to, text=final_error_message, parse_mode=ParseMode.HTML)
+        # Throttled like every other send (per-chat + global buckets, one RetryAfter retry)
+        if chat_to_send_to and context.bot: # The chat the update/callback/message came from
+            await send_throttled_message(context.bot, chat_to_send_to, final_error_message, parse_mode=ParseMode.HTML)
         elif effective_user_telegram_id and context.bot: # Fallback to PMing the user if only their Telegram ID is known
-            await context.bot.send_message(chat_id=effective_user_telegram_id, text=final_error_message, parse_mode=ParseMode.HTML)
+            await send_throttled_message(context.bot, effective_user_telegram_id, final_error_message, parse_mode=ParseMode.HTML)
         else:
-            logger.error(f"Could not send system error reply for {error_code}: No valid target (chat_id or user_id) to send the message.")
+            logger.error("Could not send system error reply for %s: No valid target (chat_id or user_id) to send the message.", error_code)
             
     except RetryAfter as e_retry:
-        logger.warning(f"Rate limited trying to send error reply for {error_code} to user '{log_user_id_str}'. Retry after {e_retry.retry_after}s.")
+        logger.warning("Rate limited trying to send error reply for %s to user '%s'. Retry after %ss.", error_code, log_user_id_str, e_retry.retry_after)
     except (TimedOut, NetworkError) as e_network:
-        logger.error(f"Network error/timeout sending error reply for {error_code} to user '{log_user_id_str}': {e_network}")
+        logger.error("Network error/timeout sending error reply for %s to user '%s': %s", error_code, log_user_id_str, e_network)
     except TelegramError as e_telegram:
-        logger.error(f"Telegram API error sending error reply for {error_code} to user '{log_user_id_str}': {e_telegram}", exc_info=True)
+        logger.exception("Telegram API error sending error reply for %s to user '%s': %s", error_code, log_user_id_str, e_telegram)
     except Exception as e_reply_critical:
-        logger.critical(f"CRITICAL: Unhandled exception in send_system_error_reply for {error_code} to user '{log_user_id_str}': {e_reply_critical}", exc_info=True)
+        logger.critical("CRITICAL: Unhandled exception in send_system_error_reply for %s to user '%s': %s", error_code, log_user_id_str, e_reply_critical, exc_info=True)
 
 # --- Other Utility Functions ---
 def get_display_name(user_obj: Any) -> str:
@@ -228,12 +404,12 @@ async def edit_message_safely(
         return True
     except TelegramError as e:
         if "message is not modified" in str(e).lower():
-            logger.info(f"Message {message_id} in chat {chat_id} was not modified (already has new content or same as before).")
+            logger.info("Message %s in chat %s was not modified (already has new content or same as before).", message_id, chat_id)
             return True # Operation is idempotent in this case, state is as desired.
-        logger.warning(f"Failed to edit message {message_id} in chat {chat_id}: {e}")
+        logger.warning("Failed to edit message %s in chat %s: %s", message_id, chat_id, e)
         return False
     except Exception as e_general:
-        logger.error(f"Unexpected error editing message {message_id} in chat {chat_id}: {e_general}", exc_info=True)
+        logger.exception("Unexpected error editing message %s in chat %s: %s", message_id, chat_id, e_general)
         return False
 
 logger.info("utils.helpers module loaded successfully.")
\ No newline at end of file
@@ -0,0 +1,26 @@
+# utils/state_definitions.py
+
+import asyncio
+from dataclasses import dataclass
+from typing import Any, MutableMapping, Union
+
+FLOW_STATE_KEY = "fs" # The single user_data key that holds a user's FlowState
+
+@dataclass(slots=True) # Slotted: fixed fields, attribute access by offset instead of a dict probe
+class FlowState:
+    """Per-user flow state shared by the step handlers, stored once in context.user_data."""
+    user_id: Union[int, None] = None
+    entry_source: Union[str, None] = None # /start deep-link payload (or the default marker)
+    secure_id: Union[str, None] = None # "USR-XXXXXXXX"; stable per user, so kept across /start resets
+    s1_state: Union[str, None] = None # Step 1 script state (UNIFIED_FLOW_* in handlers/step_1.py)
+    current_flow_step: Union[str, None] = None # Step 2+ progress marker
+    s2_scan_running: bool = False # Set while a Step 2 scan is being sent; blocks a concurrent re-trigger
+    intro_task: Union["asyncio.Task[None]", None] = None # Running Step 1 script, if any
+    input_disruption_delay_s: float = 0.0 # Extra pause consumed by the Step 1 script after stray input
+
+def get_flow_state(user_data: MutableMapping[str, Any]) -> FlowState:
+    """Returns the user's FlowState, creating it on first use."""
+    fs = user_data.get(FLOW_STATE_KEY)
+    if fs is None:
+        fs = user_data[FLOW_STATE_KEY] = FlowState()
+    return fs